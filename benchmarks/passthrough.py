@@ -0,0 +1,81 @@
+"""Compare CPU cost per request of JSON passthrough against decode/re-encode.
+
+Starts benchmarks/stub_upstream.py in a subprocess, points the trampoline at
+it and drives the Flask app in-process, measuring process CPU time per
+request with JSON_PASSTHROUGH off ("decode") and on ("passthrough").
+
+    python benchmarks/passthrough.py --requests 500 --project-kb 256
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import scratch_trampline  # noqa: E402
+
+# Each request uses a fresh id so the response cache never answers it.
+ROUTES = {
+    'project': '/projects/{}',
+    'studio_projects': '/studios/{}/projects',
+}
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'stub upstream did not start on port {port}')
+
+
+def measure(client, path, requests, first_id):
+    client.get(path.format(first_id))  # warm up the pooled connection
+    start = time.process_time()
+    for i in range(1, requests + 1):
+        response = client.get(path.format(first_id + i))
+        assert response.status_code == 200, response.status_code
+    return (time.process_time() - start) / requests * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--port', type=int, default=8950)
+    parser.add_argument('--project-kb', type=int, default=256)
+    args = parser.parse_args(argv)
+
+    stub = subprocess.Popen([sys.executable, os.path.join(HERE, 'stub_upstream.py'),
+                             '--port', str(args.port), '--project-kb', str(args.project_kb)])
+    try:
+        wait_for_port(args.port)
+        if stub.poll() is not None:
+            raise RuntimeError(f'stub upstream exited; is port {args.port} already in use?')
+        scratch_trampline.UPSTREAM_HOSTS['api'] = f'http://127.0.0.1:{args.port}'
+        client = scratch_trampline.app.test_client()
+        results = {}
+        first_id = 1
+        for route, path in ROUTES.items():
+            for mode, passthrough in (('decode', False), ('passthrough', True)):
+                scratch_trampline.JSON_PASSTHROUGH = passthrough
+                results.setdefault(route, {})[mode] = round(measure(client, path, args.requests, first_id), 3)
+                first_id += args.requests + 1
+            results[route]['speedup'] = round(results[route]['decode'] / results[route]['passthrough'], 2)
+        print(json.dumps({'cpu_ms_per_request': results, 'requests': args.requests,
+                          'project_kb': args.project_kb}, indent=2))
+    finally:
+        scratch_trampline.upstream.stop()
+        stub.terminate()
+        stub.wait()
+
+
+if __name__ == '__main__':
+    main()
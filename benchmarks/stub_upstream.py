@@ -0,0 +1,121 @@
+"""A local stand-in for the Scratch servers used by the benchmarks.
+
+Serves canned responses of configurable size for every path: project JSON,
+list pages, small user/session JSON, PNG images and acknowledgements for
+writes. Responses can be delayed and a share of them replaced by 500s or
+429s. Listening on several ports lets each upstream host (api, cdn2, site)
+get its own address.
+
+    python benchmarks/stub_upstream.py --port 8950 --project-kb 256
+    python benchmarks/stub_upstream.py --port 8950 8951 8952 --latency-ms 20 --throttle-rate 0.01
+"""
+from aiohttp import web
+import argparse
+import asyncio
+import json
+import random
+
+# Paths ending in one of these are answered with a page of projects.
+LIST_SUFFIXES = ('/projects', '/remixes', '/favorites', '/followers', '/following', '/curators', '/managers',
+                 '/studios', '/comments', '/replies', '/activity')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def make_project(project_id, size_kb):
+    """A project record padded out to roughly ``size_kb`` kilobytes."""
+    padding = 'x' * 64
+    project = {
+        'id': project_id,
+        'title': f'Project {project_id}',
+        'description': '',
+        'instructions': '',
+        'stats': {'views': 1000, 'loves': 100, 'favorites': 50, 'remixes': 5},
+        'image': f'https://cdn2.scratch.mit.edu/get_image/project/{project_id}_480x360.png',
+        'history': {'created': '2020-01-01T00:00:00.000Z', 'modified': '2020-01-02T00:00:00.000Z'},
+        'tags': [],
+    }
+    while len(json.dumps(project)) < size_kb * 1024:
+        project['tags'].append({'name': padding, 'count': len(project['tags'])})
+    return project
+
+
+def make_user(username):
+    return {
+        'id': 1,
+        'username': username,
+        'scratchteam': False,
+        'history': {'joined': '2020-01-01T00:00:00.000Z'},
+        'profile': {'id': 1, 'status': '', 'bio': '', 'country': 'Location not given'},
+    }
+
+
+def make_app(project_kb=64, page_size=40, image_kb=32, latency_ms=0, error_rate=0.0, throttle_rate=0.0,
+             retry_after=1):
+    project_body = json.dumps(make_project(1, project_kb)).encode()
+    page_body = json.dumps([make_project(i, 2) for i in range(page_size)]).encode()
+    user_body = json.dumps(make_user('benchmark')).encode()
+    image_body = PNG_SIGNATURE + bytes(random.getrandbits(8) for _ in range(image_kb * 1024))
+
+    async def handler(request):
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        roll = random.random()
+        if roll < throttle_rate:
+            return web.json_response({'code': 'TooManyRequests'}, status=429,
+                                     headers={'Retry-After': str(retry_after)})
+        if roll < throttle_rate + error_rate:
+            return web.json_response({'code': 'InternalError'}, status=500)
+
+        path = request.path
+        if request.method != 'GET':
+            received = await request.read()
+            return web.json_response({'ok': True, 'received': len(received)})
+        if path.startswith('/get_image/'):
+            return web.Response(body=image_body, content_type='image/png')
+        if path.endswith(LIST_SUFFIXES):
+            body = page_body
+        elif path.startswith('/projects/'):
+            body = project_body
+        else:
+            body = user_body
+        return web.Response(body=body, content_type='application/json')
+
+    stub = web.Application()
+    stub.router.add_route('*', '/{tail:.*}', handler)
+    return stub
+
+
+async def serve(stub, host, ports):
+    runner = web.AppRunner(stub)
+    await runner.setup()
+    for port in ports:
+        await web.TCPSite(runner, host, port).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, nargs='+', default=[8950], help='one or more ports to listen on')
+    parser.add_argument('--project-kb', type=int, default=64, help='size of /projects/<id> bodies')
+    parser.add_argument('--page-size', type=int, default=40, help='items per list page')
+    parser.add_argument('--image-kb', type=int, default=32, help='size of images')
+    parser.add_argument('--latency-ms', type=float, default=0, help='delay before every response')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of requests answered with a 500')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='share of requests answered with a 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with 429s')
+    args = parser.parse_args(argv)
+    stub = make_app(args.project_kb, args.page_size, args.image_kb, args.latency_ms, args.error_rate,
+                    args.throttle_rate, args.retry_after)
+    try:
+        asyncio.run(serve(stub, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""Measure trampoline throughput, latency and memory per route family.
+
+Starts benchmarks/stub_upstream.py on three ports (api, cdn2 and site) and
+the trampoline once per --server mode, pointed at the stub with --upstream.
+Each route family is then driven by concurrent clients for --duration
+seconds. Results are printed as JSON (and written to --output); with
+--baseline, the run fails if any family lost more than --tolerance of its
+throughput or p99 latency against an earlier result file.
+
+    python benchmarks/throughput.py --server flask aiohttp --duration 10 --concurrency 32
+    python benchmarks/throughput.py --latency-ms 20 --throttle-rate 0.01 --output results.json
+    python benchmarks/throughput.py --baseline results.json
+"""
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TRAMPOLINE = os.path.join(os.path.dirname(HERE), 'scratch_trampline.py')
+
+# Route family -> (method, path template, JSON body). Every request fills in
+# a fresh id so the response cache never answers it.
+FAMILIES = {
+    'small_json': ('GET', '/users/user{}', None),
+    'project_json': ('GET', '/projects/{}', None),
+    'list_page': ('GET', '/users/user{}/projects?limit=40&offset=0', None),
+    'image': ('GET', '/cdn2/get_image/project/{}_480x360.png', None),
+    'write': ('PUT', '/projects/{}', {'title': 'benchmark', 'instructions': 'x' * 512}),
+}
+
+UPSTREAM_PORT_OFFSETS = {'api': 0, 'cdn2': 1, 'site': 2}
+
+# Per-host rate limit given to the trampoline unless --keep-rate-limits, so
+# the stub rather than the limiter sets the pace.
+UNLIMITED_RATE = '1e9'
+
+
+def wait_for_port(port, process, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'process listening on port {port} exited; is the port already in use?')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'nothing listening on port {port}')
+
+
+def memory_mb(pid):
+    """Current and peak resident set size of a process in MiB, from /proc (Linux only)."""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            fields = dict(line.split(':', 1) for line in status)
+    except OSError:
+        return None, None
+    return tuple(round(int(fields[key].split()[0]) / 1024, 1) for key in ('VmRSS', 'VmHWM'))
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return round(sorted_values[index] * 1000, 2)
+
+
+async def drive(base_url, family, duration, concurrency, ids):
+    """Send requests for one family from ``concurrency`` clients for ``duration`` seconds."""
+    method, template, body = FAMILIES[family]
+    latencies = []
+    statuses = {}
+    headers = {'x-token': 'benchmark'} if method != 'GET' else {}
+    connector = TCPConnector(limit=concurrency)
+    # Bodies are read but never decompressed, keeping the load generator cheap.
+    async with ClientSession(base_url, connector=connector, auto_decompress=False,
+                             timeout=ClientTimeout(total=30)) as session:
+        deadline = time.perf_counter() + duration
+
+        async def client():
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    async with session.request(method, template.format(next(ids)), json=body,
+                                               headers=headers) as response:
+                        await response.read()
+                        status = response.status
+                except (ClientError, asyncio.TimeoutError):
+                    status = 'error'
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'rps': round(len(latencies) / elapsed, 1),
+        'latency_ms': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': percentile(latencies, 100),
+        },
+    }
+
+
+def run_mode(server, args):
+    """Start the trampoline in one serving mode and benchmark every family against it."""
+    command = [sys.executable, TRAMPOLINE, '--server', server, '--port', str(args.trampoline_port)]
+    for name, offset in UPSTREAM_PORT_OFFSETS.items():
+        command += ['--upstream', f'{name}=http://127.0.0.1:{args.stub_port + offset}']
+        if not args.keep_rate_limits:
+            command += ['--rate-limit', f'{name}={UNLIMITED_RATE}']
+    trampoline = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.trampoline_port, trampoline)
+        base_url = f'http://127.0.0.1:{args.trampoline_port}'
+        ids = itertools.count(1)
+        results = {}
+        for family in args.families:
+            asyncio.run(drive(base_url, family, args.warmup, args.concurrency, ids))
+            result = asyncio.run(drive(base_url, family, args.duration, args.concurrency, ids))
+            result['rss_mb'], result['peak_rss_mb'] = memory_mb(trampoline.pid)
+            results[family] = result
+        return results
+    finally:
+        trampoline.terminate()
+        trampoline.wait()
+
+
+def regressions(results, baseline, tolerance):
+    """Families whose throughput fell or p99 latency rose by more than ``tolerance``."""
+    found = []
+    for server, families in results.items():
+        for family, result in families.items():
+            before = baseline.get(server, {}).get(family)
+            if before is None:
+                continue
+            if result['rps'] < before['rps'] * (1 - tolerance):
+                found.append(f'{server}/{family}: {before["rps"]} -> {result["rps"]} req/s')
+            p99, before_p99 = result['latency_ms']['p99'], before['latency_ms']['p99']
+            if p99 is not None and before_p99 and p99 > before_p99 * (1 + tolerance):
+                found.append(f'{server}/{family}: p99 {before_p99} -> {p99} ms')
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', nargs='+', choices=('flask', 'aiohttp'), default=['flask', 'aiohttp'])
+    parser.add_argument('--families', nargs='+', choices=tuple(FAMILIES), default=list(FAMILIES))
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load per family')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds of unmeasured load per family')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--stub-port', type=int, default=8950, help='first of three ports for the stub')
+    parser.add_argument('--trampoline-port', type=int, default=8960)
+    parser.add_argument('--project-kb', type=int, default=64)
+    parser.add_argument('--image-kb', type=int, default=32)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--keep-rate-limits', action='store_true',
+                        help='leave the per-host upstream rate limits in force')
+    parser.add_argument('--output', help='also write the results to this file')
+    parser.add_argument('--baseline', help='earlier results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed regression, as a fraction')
+    args = parser.parse_args(argv)
+
+    ports = [str(args.stub_port + offset) for offset in UPSTREAM_PORT_OFFSETS.values()]
+    stub = subprocess.Popen([sys.executable, os.path.join(HERE, 'stub_upstream.py'), '--port', *ports,
+                             '--project-kb', str(args.project_kb), '--image-kb', str(args.image_kb),
+                             '--latency-ms', str(args.latency_ms), '--error-rate', str(args.error_rate),
+                             '--throttle-rate', str(args.throttle_rate)])
+    try:
+        wait_for_port(args.stub_port, stub)
+        results = {server: run_mode(server, args) for server in args.server}
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    report = {
+        'config': {key: getattr(args, key) for key in ('duration', 'concurrency', 'project_kb', 'image_kb',
+                                                       'latency_ms', 'error_rate', 'throttle_rate',
+                                                       'keep_rate_limits')},
+        'results': results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            found = regressions(results, json.load(baseline)['results'], args.tolerance)
+        for regression in found:
+            print(f'regression: {regression}', file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
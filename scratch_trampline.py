@@ -1,558 +1,3534 @@
-from flask import Flask, request, jsonify
-import requests
-from aiohttp import web, ClientSession
+from flask import Flask, Response, request, jsonify, send_file
+from aiohttp import (web, ClientConnectionError, ClientConnectorError, ClientError, ClientSession, ClientTimeout,
+                     TCPConnector, DummyCookieJar, TraceConfig)
+from bisect import bisect_left
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qs, quote, urlencode, urlsplit
+from werkzeug.exceptions import HTTPException
+from werkzeug.serving import WSGIRequestHandler, make_server
+import argparse
 import asyncio
+import atexit
+import contextvars
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import random
+import os
+import re
+import select
+import signal
+import socket
+import sqlite3
+import string
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; without it upstream never sends br
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it images are only relayed
+    Image = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the json module is used without it
+    orjson = None
+
+# Upstream hosts the trampoline forwards to, keyed by a short name.
+UPSTREAM_HOSTS = {
+    'api': 'https://api.scratch.mit.edu',
+    'cdn2': 'https://cdn2.scratch.mit.edu',
+    'site': 'https://scratch.mit.edu',
+}
+
+# Connection pool limits per upstream host. ``limit`` caps the number of
+# simultaneous connections and ``keepalive_timeout`` is how long (seconds) an
+# idle connection is kept open for reuse.
+UPSTREAM_POOL_LIMITS = {
+    'api': {'limit': 100, 'keepalive_timeout': 30},
+    'cdn2': {'limit': 50, 'keepalive_timeout': 30},
+    'site': {'limit': 10, 'keepalive_timeout': 15},
+}
+
+
+class UpstreamClient:
+    """Process-wide keep-alive connection pools to the Scratch servers.
+
+    One aiohttp ClientSession is kept per upstream host so TCP and TLS
+    connections are reused across requests. All sessions live on a single
+    event loop: either a background thread started by start() (used by the
+    Flask app) or an already running loop via open() (used by async servers).
+    """
 
-async def fetch_data(url, headers=None, cookies=None):
-    """Fetch data from a given URL with optional headers and cookies.
-    
-    Returns a tuple of (data, content_type) where data is the JSON response
-    and content_type is the Content-Type header from the response.
+    def __init__(self, hosts, pool_limits):
+        self.hosts = hosts
+        self.pool_limits = pool_limits
+        self.loop = None
+        self._thread = None
+        self._sessions = {}
+        self._netlocs = {}
+        self._lock = threading.Lock()
+
+    async def open(self):
+        """Create the per-host sessions on the running event loop."""
+        for name, base_url in self.hosts.items():
+            limits = self.pool_limits.get(name, {})
+            connector = TCPConnector(
+                limit=limits.get('limit', 100),
+                keepalive_timeout=limits.get('keepalive_timeout', 30),
+                ttl_dns_cache=300,
+            )
+            # Cookies are passed per request; never let one client's
+            # Set-Cookie leak into another client's requests.
+            # auto_decompress is off so encoded bodies can be relayed untouched.
+            self._sessions[name] = ClientSession(connector=connector, cookie_jar=DummyCookieJar(),
+                                                 auto_decompress=False, trace_configs=[upstream_trace_config()])
+            self._netlocs[urlsplit(base_url).netloc] = name
+        self.loop = asyncio.get_running_loop()
+
+    async def close(self):
+        """Close every session and its pooled connections."""
+        sessions = list(self._sessions.values())
+        self._sessions = {}
+        self._netlocs = {}
+        self.loop = None
+        for session in sessions:
+            await session.close()
+
+    def start(self):
+        """Start the background event loop thread if it is not running."""
+        with self._lock:
+            if self.loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=loop.run_forever, name='upstream-loop', daemon=True)
+            self._thread.start()
+            asyncio.run_coroutine_threadsafe(self.open(), loop).result()
+
+    def stop(self):
+        """Close the pools and stop the background loop thread, if any."""
+        with self._lock:
+            if self._thread is None:
+                return
+            loop = self.loop
+            asyncio.run_coroutine_threadsafe(self.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join()
+            loop.close()
+            self._thread = None
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the upstream loop from a worker thread and wait for it.
+
+        The coroutine sees the calling thread's request timer, so its upstream
+        calls are attributed to the request.
+        """
+        if self.loop is None:
+            self.start()
+        started = time.perf_counter()
+        try:
+            return asyncio.run_coroutine_threadsafe(with_request_timer(request_timer.get(), coro),
+                                                    self.loop).result(timeout)
+        finally:
+            add_upstream_wait(started)
+
+    def host_for(self, url):
+        """Return the UPSTREAM_HOSTS name for the host of ``url``."""
+        name = self._netlocs.get(urlsplit(url).netloc)
+        if name is None:
+            raise ValueError(f'Not an upstream host: {url}')
+        return name
+
+    def session_for(self, url):
+        """Return the pooled session for the host of ``url``."""
+        return self._sessions[self.host_for(url)]
+
+    def pool_stats(self):
+        """Connections in use, idle and waited for in each host's pool."""
+        stats = {}
+        for name, session in list(self._sessions.items()):
+            connector = session.connector
+            stats[name] = {
+                'limit': connector.limit,
+                'in_use': len(connector._acquired),
+                'idle': sum(len(conns) for conns in list(connector._conns.values())),
+                'waiting': sum(len(waiters) for waiters in list(connector._waiters.values())),
+            }
+        return stats
+
+
+upstream = UpstreamClient(UPSTREAM_HOSTS, UPSTREAM_POOL_LIMITS)
+atexit.register(upstream.stop)
+
+
+# Request rate allowed per upstream host: ``rate`` requests per second on
+# average, with bursts of up to ``burst``. These are per process; --rate-limit
+# overrides them, and --prefork splits them between the workers.
+UPSTREAM_RATE_LIMITS = {
+    'api': {'rate': 50, 'burst': 100},
+    'cdn2': {'rate': 200, 'burst': 400},
+    'site': {'rate': 10, 'burst': 20},
+}
+
+BREAKER_THRESHOLD = 5  # consecutive failures that open the circuit
+BREAKER_COOLDOWN = 10  # seconds before a probe request is let through
+QUEUE_TIMEOUT = 5  # longest a request waits for its turn before failing
+THROTTLE_BACKOFF = 1  # seconds to hold off after a 429 without Retry-After
+MAX_RETRY_AFTER_WAIT = 2  # a throttled GET is retried once if asked to wait no longer
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Priority of upstream requests made by the current task. Fan-outs and
+# batches set it to PRIORITY_BULK so single requests go ahead of them.
+upstream_priority = contextvars.ContextVar('upstream_priority', default=PRIORITY_INTERACTIVE)
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling upstream while a host is throttling us or failing."""
+
+    def __init__(self, host, retry_after):
+        super().__init__(f'Scratch {host} is unavailable, retry in {math.ceil(retry_after)}s')
+        self.host = host
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delay or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    """Admission control for requests to one upstream host.
+
+    Combines a token bucket, a hold-off window set from Retry-After, a
+    priority queue of waiting requests and a circuit breaker that rejects
+    requests outright after repeated failures. Must only be used from the
+    upstream event loop.
     """
-    async with ClientSession() as session:
-        async with session.get(url, headers=headers, cookies=cookies) as response:
-            data = await response.json()
-            content_type = response.headers.get('Content-Type')
-            return data, content_type, response.status  # Return both data and Content-Type
 
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.failures = 0
+        self.opened_at = None
+        self.throttled = 0
+        self.rejected = 0
+        self.retries = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._pump_task = None
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _reject(self, retry_after):
+        self.rejected += 1
+        raise UpstreamUnavailable(self.name, retry_after)
+
+    async def acquire(self, priority):
+        """Wait for permission to send one request."""
+        now = time.monotonic()
+        if self.opened_at is not None:
+            if now - self.opened_at < BREAKER_COOLDOWN:
+                self._reject(self.opened_at + BREAKER_COOLDOWN - now)
+            # Half open: this request probes upstream, the rest wait out another cooldown.
+            self.opened_at = now
+        if self.blocked_until - now > QUEUE_TIMEOUT:
+            self._reject(self.blocked_until - now)
+        self._refill(now)
+        if not self._waiters and now >= self.blocked_until and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.ensure_future(self._pump())
+        try:
+            await asyncio.wait_for(future, QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._reject(max(self.blocked_until - time.monotonic(), 1 / self.rate))
+
+    async def _pump(self):
+        """Hand out tokens to queued requests, highest priority first."""
+        while self._waiters:
+            now = time.monotonic()
+            self._refill(now)
+            delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():  # skip requests that gave up waiting
+                self.tokens -= 1
+                future.set_result(None)
+
+    def record(self, status, headers):
+        """Account for an upstream response; returns the Retry-After delay, if any."""
+        retry_after = None
+        if status in (429, 503):
+            retry_after = parse_retry_after(headers.get('Retry-After'))
+            if retry_after is None and status == 429:
+                retry_after = THROTTLE_BACKOFF
+            if retry_after is not None:
+                self.throttled += 1
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        if status == 429 or status >= 500:
+            self.record_failure()
+        else:
+            self.failures = 0
+            self.opened_at = None
+        return retry_after
+
+    def accepting(self):
+        """Whether requests are being let through without delay: not throttled and circuit closed."""
+        return self.opened_at is None and time.monotonic() >= self.blocked_until
+
+    def record_failure(self):
+        """Account for a failed upstream request (5xx, 429 or connection error)."""
+        self.failures += 1
+        if self.failures >= BREAKER_THRESHOLD:
+            self.opened_at = time.monotonic()
+
+    def stats(self):
+        return {
+            'tokens': round(self.tokens, 2),
+            'queued': len(self._waiters),
+            'throttled': self.throttled,
+            'rejected': self.rejected,
+            'retries': self.retries,
+            'circuit_open': self.opened_at is not None,
+        }
 
 
-app = Flask(__name__)
+class UpstreamDispatcher:
+    """The HostLimiter for each upstream host, created on first use."""
 
-@app.after_request
-def add_cors_headers(response):
-    """Add CORS headers to all responses."""
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-    response.headers.add('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-    return response
+    def __init__(self, rate_limits):
+        self.rate_limits = rate_limits
+        self._limiters = {}
 
-def get_xtoken_header(request):
-    xtoken = request.headers.get('x-token', None)
-    if not xtoken:
-        header = {}
-    else:
-        header = {
-            'x-token': xtoken
+    def limiter(self, host):
+        limiter = self._limiters.get(host)
+        if limiter is None:
+            limits = self.rate_limits.get(host, {'rate': 50, 'burst': 100})
+            limiter = self._limiters[host] = HostLimiter(host, limits['rate'], limits['burst'])
+        return limiter
+
+    def stats(self):
+        return {host: limiter.stats() for host, limiter in self._limiters.items()}
+
+
+dispatcher = UpstreamDispatcher(UPSTREAM_RATE_LIMITS)
+
+
+# Upstream timeouts per route family: for connecting, between reads of the
+# response, and for the whole request. '<family>:<METHOD>' entries override
+# the family's timeout for one method. Families not listed use 'default'.
+UPSTREAM_TIMEOUTS = {
+    'default': ClientTimeout(total=10, connect=3, sock_read=5),
+    'feed': ClientTimeout(total=15, connect=3, sock_read=10),
+    'write': ClientTimeout(total=15, connect=3, sock_read=10),
+    'project:PUT': ClientTimeout(total=60, connect=3, sock_read=30),  # large project saves
+    'image': ClientTimeout(total=60, connect=3, sock_read=10),
+}
+
+CONNECT_RETRIES = 2  # extra attempts after a connection error
+RETRY_BACKOFF = 0.1  # seconds; retries wait a random time up to this, doubling each time
+
+# GETs for these families are hedged: if upstream has not answered after the
+# family's recent p95 latency, a second request is sent and the first answer
+# wins. Set to an empty set to turn hedging off.
+HEDGED_FAMILIES = frozenset({'project', 'studio', 'user', 'list', 'comments', 'activity'})
+HEDGE_PERCENTILE = 95
+HEDGE_DEFAULT_DELAY = 0.5  # seconds, until enough latencies have been seen
+HEDGE_MIN_DELAY = 0.02
+HEDGE_MAX_DELAY = 2
+HEDGE_SAMPLES = 256  # recent latencies kept per family
+# Every hedged-family request adds this much to the hedge budget and every
+# hedge spends 1, so hedges add at most this share of extra upstream load.
+HEDGE_BUDGET_RATIO = 0.05
+HEDGE_BUDGET_MAX = 10
+
+
+def upstream_timeout(family, method='GET'):
+    timeout = UPSTREAM_TIMEOUTS.get(f'{family}:{method}') or UPSTREAM_TIMEOUTS.get(family)
+    return timeout or UPSTREAM_TIMEOUTS['default']
+
+def retryable(exc, method):
+    """Whether a request that failed with ``exc`` may be sent again.
+
+    A failure to connect means nothing was sent, so any request may be
+    retried; other connection errors only for GETs. Timeouts are not
+    retried, as that would only pile more load on a slow upstream.
+    """
+    if isinstance(exc, asyncio.TimeoutError):
+        return False
+    if isinstance(exc, ClientConnectorError):
+        return True
+    return method == 'GET' and isinstance(exc, ClientConnectionError)
+
+
+class Hedger:
+    """Sends a second copy of a slow idempotent request and takes whichever answers first.
+
+    The hedge is sent once the first attempt has been outstanding for the
+    family's recent HEDGE_PERCENTILE latency. Hedges are paid for from a
+    budget refilled by HEDGE_BUDGET_RATIO per request, and none are sent to
+    a host that is throttling us or has its circuit open, so hedging cannot
+    amplify load during an upstream incident. Must only be used from the
+    upstream event loop.
+    """
+
+    def __init__(self):
+        self.budget = HEDGE_BUDGET_MAX
+        self.hedged = 0
+        self.wins = 0
+        self.skipped = 0
+        self._latencies = {}
+        self._delays = {}
+
+    def delay(self, family):
+        return self._delays.get(family, HEDGE_DEFAULT_DELAY)
+
+    def observe(self, family, seconds):
+        """Record the latency of an unhedged attempt, updating the family's hedge delay now and then."""
+        samples = self._latencies.get(family)
+        if samples is None:
+            samples = self._latencies[family] = deque(maxlen=HEDGE_SAMPLES)
+        samples.append(seconds)
+        if len(samples) >= 32 and len(samples) % 16 == 0:
+            ranked = sorted(samples)
+            p = ranked[min(len(ranked) - 1, len(ranked) * HEDGE_PERCENTILE // 100)]
+            self._delays[family] = min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, p))
+
+    async def run(self, host, family, attempt):
+        """Await ``attempt()``, hedging it with a second call if it is slow."""
+        self.budget = min(HEDGE_BUDGET_MAX, self.budget + HEDGE_BUDGET_RATIO)
+        started = time.monotonic()
+
+        def observe_first(task):
+            if not task.cancelled() and task.exception() is None:
+                self.observe(family, time.monotonic() - started)
+
+        first = asyncio.ensure_future(attempt())
+        first.add_done_callback(observe_first)
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.delay(family))
+            if done:
+                return first.result()
+            if self.budget < 1 or not dispatcher.limiter(host).accepting():
+                self.skipped += 1
+                return await first
+            self.budget -= 1
+            self.hedged += 1
+            tasks.append(asyncio.ensure_future(attempt()))
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.wins += 1
+                        return task.result()
+            return first.result()  # both failed: raise the first attempt's error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        return {'hedged': self.hedged, 'wins': self.wins, 'skipped': self.skipped,
+                'delays': {family: round(delay, 4) for family, delay in self._delays.items()}}
+
+
+hedger = Hedger()
+
+
+# --- metrics -------------------------------------------------------------
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LATENCY_BUCKET_LABELS = tuple(f'{bound:g}' for bound in LATENCY_BUCKETS) + ('+Inf',)
+
+# Route label for requests that matched no route.
+UNMATCHED_ROUTE = 'unmatched'
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class RouteSeries:
+    """Counters for one route: responses by status, latency histograms and bytes sent.
+
+    The histograms hold one count per LATENCY_BUCKETS entry plus one for
+    +Inf; counts are per bucket, not cumulative.
+    """
+
+    __slots__ = ('statuses', 'upstream', 'upstream_sum', 'proxy', 'proxy_sum', 'bytes', 'in_flight')
+
+    def __init__(self):
+        self.statuses = {}
+        self.upstream = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.upstream_sum = 0.0
+        self.proxy = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.proxy_sum = 0.0
+        self.bytes = 0
+        self.in_flight = 0
+
+    def add(self, other):
+        """Add another series' counters to this one."""
+        for status, count in list(other.statuses.items()):
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        for i in range(len(self.upstream)):
+            self.upstream[i] += other.upstream[i]
+            self.proxy[i] += other.proxy[i]
+        self.upstream_sum += other.upstream_sum
+        self.proxy_sum += other.proxy_sum
+        self.bytes += other.bytes
+        self.in_flight += other.in_flight
+
+
+class RequestTimer:
+    """A request in flight: its route's series, when it started and time spent waiting on upstream.
+
+    The upstream wait is further broken down into TIMING_PHASES, summed over
+    every upstream call made for the request (so concurrent calls can add up
+    to more than the wait itself).
+    """
+
+    __slots__ = ('series', 'route', 'method', 'path', 'started', 'upstream', 'status', 'bytes',
+                 'queue', 'connect', 'ttfb', 'transfer')
+
+    def __init__(self, series, route, method, path):
+        self.series = series
+        self.route = route
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.upstream = 0.0
+        self.status = 500
+        self.bytes = 0
+        self.queue = 0.0
+        self.connect = 0.0
+        self.ttfb = 0.0
+        self.transfer = 0.0
+
+
+# Timer of the request being served by this thread (Flask) or task (aiohttp).
+request_timer = contextvars.ContextVar('request_timer', default=None)
+
+
+class Metrics:
+    """Per-route request metrics that are cheap enough to always record.
+
+    Counters live in per-thread shards (route name -> RouteSeries) so
+    recording never takes a lock: each shard only has one writer, and a
+    scrape sums them. Shards are keyed by thread ident, so a thread that
+    takes the place of a finished one reuses its shard. A request must be
+    finished on the thread that started it.
+    """
+
+    def __init__(self):
+        self._shards = {}
+
+    def start(self, route, method=None, path=None):
+        """Count a request to ``route`` as in flight and return its RequestTimer."""
+        ident = threading.get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            shard = self._shards[ident] = {}
+        route = route or UNMATCHED_ROUTE
+        series = shard.get(route)
+        if series is None:
+            series = shard[route] = RouteSeries()
+        series.in_flight += 1
+        return RequestTimer(series, route, method, path)
+
+    def finish(self, timer):
+        """Record a finished request; the rest of its time is proxy overhead."""
+        elapsed = time.perf_counter() - timer.started
+        upstream_wait = min(timer.upstream, elapsed)
+        series = timer.series
+        series.in_flight -= 1
+        series.statuses[timer.status] = series.statuses.get(timer.status, 0) + 1
+        series.upstream[bisect_left(LATENCY_BUCKETS, upstream_wait)] += 1
+        series.upstream_sum += upstream_wait
+        series.proxy[bisect_left(LATENCY_BUCKETS, elapsed - upstream_wait)] += 1
+        series.proxy_sum += elapsed - upstream_wait
+        series.bytes += timer.bytes
+
+    def collect(self):
+        """Sum the shards into one RouteSeries per route."""
+        totals = {}
+        for shard in list(self._shards.values()):
+            for route, series in list(shard.items()):
+                if route not in totals:
+                    totals[route] = RouteSeries()
+                totals[route].add(series)
+        return totals
+
+
+route_metrics = Metrics()
+
+
+# Parts of the upstream wait timed for Server-Timing and the slow request log:
+# waiting for the host's rate limiter or a pooled connection, opening a
+# connection, from sending the request to its response headers, and reading
+# a buffered response body.
+TIMING_PHASES = ('queue', 'connect', 'ttfb', 'transfer')
+
+SERVER_TIMING = False  # add a Server-Timing header to responses; set by --server-timing
+SLOW_REQUEST_SECONDS = 1.0
+SLOW_LOG_SAMPLE_RATE = 1.0  # share of slow requests logged
+SLOW_LOG_MAX_PENDING = 1000  # records waiting to be written before new ones are dropped
+SLOW_LOG_FLUSH_INTERVAL = 1  # seconds
+
+
+def add_upstream_wait(started):
+    """Count the time since ``started`` towards the current request's upstream wait."""
+    timer = request_timer.get()
+    if timer is not None:
+        timer.upstream += time.perf_counter() - started
+
+def add_phase(phase, seconds):
+    """Count ``seconds`` towards one of the TIMING_PHASES of the current request."""
+    timer = request_timer.get()
+    if timer is not None:
+        setattr(timer, phase, getattr(timer, phase) + seconds)
+
+async def with_request_timer(timer, awaitable):
+    """Await ``awaitable`` with ``timer`` as the request timer, for work handed to the upstream loop."""
+    request_timer.set(timer)
+    return await awaitable
+
+def upstream_trace_config():
+    """An aiohttp TraceConfig timing connection pool waits, connects and time to first byte."""
+    trace = TraceConfig()
+
+    async def request_start(session, context, params):
+        context.started = time.perf_counter()
+        context.setup = 0.0
+
+    async def mark(session, context, params):
+        context.mark = time.perf_counter()
+
+    def setup_phase(phase):
+        async def end(session, context, params):
+            seconds = time.perf_counter() - context.mark
+            context.setup += seconds
+            add_phase(phase, seconds)
+        return end
+
+    async def request_end(session, context, params):
+        add_phase('ttfb', time.perf_counter() - context.started - context.setup)
+
+    trace.on_request_start.append(request_start)
+    trace.on_connection_queued_start.append(mark)
+    trace.on_connection_queued_end.append(setup_phase('queue'))
+    trace.on_connection_create_start.append(mark)
+    trace.on_connection_create_end.append(setup_phase('connect'))
+    trace.on_request_end.append(request_end)
+    return trace
+
+def server_timing(timer):
+    """The Server-Timing header value for a request, as far as it has got."""
+    elapsed = time.perf_counter() - timer.started
+    upstream = min(timer.upstream, elapsed)
+    metrics = [f'{phase};dur={getattr(timer, phase) * 1000:.1f}' for phase in TIMING_PHASES]
+    metrics.append(f'upstream;dur={upstream * 1000:.1f}')
+    metrics.append(f'proxy;dur={(elapsed - upstream) * 1000:.1f}')
+    metrics.append(f'total;dur={elapsed * 1000:.1f}')
+    return ', '.join(metrics)
+
+
+class SlowRequestLog:
+    """Writes a JSON line for a sample of requests slower than a threshold.
+
+    Requests only append a record to an in-memory buffer; a background
+    thread writes the buffer out every SLOW_LOG_FLUSH_INTERVAL seconds, so
+    logging never waits on the disk. Records arriving while the buffer is
+    full are dropped and counted. The thread is started on first use, in
+    the process that logs, so a pre-fork master does not need one.
+    """
+
+    def __init__(self, path, threshold=SLOW_REQUEST_SECONDS, sample_rate=SLOW_LOG_SAMPLE_RATE):
+        self.path = path
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.dropped = 0
+        self._pending = deque()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def offer(self, timer):
+        """Log a finished request if it was slow and is sampled."""
+        elapsed = time.perf_counter() - timer.started
+        if elapsed < self.threshold or random.random() >= self.sample_rate:
+            return
+        if len(self._pending) >= SLOW_LOG_MAX_PENDING:
+            self.dropped += 1
+            return
+        upstream = min(timer.upstream, elapsed)
+        record = {
+            'time': round(time.time(), 3),
+            'pid': os.getpid(),
+            'route': timer.route,
+            'method': timer.method,
+            'path': timer.path,
+            'status': timer.status,
+            'bytes': timer.bytes,
+            'total_ms': round(elapsed * 1000, 1),
+            'upstream_ms': round(upstream * 1000, 1),
+            'proxy_ms': round((elapsed - upstream) * 1000, 1),
         }
-    return header
+        for phase in TIMING_PHASES:
+            record[f'{phase}_ms'] = round(getattr(timer, phase) * 1000, 1)
+        self._pending.append(record)
+        if self._pid != os.getpid():
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='slow-request-log', daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def stop(self):
+        """Write out what is buffered and stop the writer thread, if this process started one."""
+        if self._pid != os.getpid():
+            return
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(SLOW_LOG_FLUSH_INTERVAL)
+
+    def _run(self):
+        output = sys.stderr if self.path == '-' else open(self.path, 'a')
+        while True:
+            self._wake.wait(SLOW_LOG_FLUSH_INTERVAL)
+            self._wake.clear()
+            lines = []
+            while self._pending:
+                lines.append(json.dumps(self._pending.popleft()) + '\n')
+            if lines:
+                output.write(''.join(lines))
+                output.flush()
+            if self._stopping:
+                return
+
+
+slow_request_log = None  # a SlowRequestLog, when enabled with --slow-log
+
+
+def finish_request(timer):
+    """Record a finished request in route_metrics and, if slow, the slow request log."""
+    route_metrics.finish(timer)
+    if slow_request_log is not None:
+        slow_request_log.offer(timer)
+
+async def upstream_wait(awaitable):
+    """Await an upstream call from an aiohttp handler, timing it as upstream wait."""
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        add_upstream_wait(started)
+
+async def upstream_chunks(chunks):
+    """Re-yield an async iterator of upstream data, timing each wait as upstream wait."""
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                add_upstream_wait(started)
+            yield chunk
+    finally:
+        aclose = getattr(chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+class MeteredBody:
+    """Wraps a streamed Flask response body to count the bytes sent."""
+
+    def __init__(self, body, timer):
+        self.body = body
+        self.timer = timer
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.timer.bytes += len(chunk)
+            yield chunk
+
+    def close(self):
+        close = getattr(self.body, 'close', None)
+        if close is not None:
+            close()
+
+
+class MeteredStreamResponse(web.StreamResponse):
+    """A StreamResponse counting the body bytes written, like MeteredBody for Flask.
+
+    body_length would include the headers and chunk framing.
+    """
 
-@app.route('/projects/<int:project_id>', methods=['GET', 'OPTIONS', 'PUT'])
-def get_project(project_id):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/projects/{project_id}'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+    async def write(self, data):
+        timer = request_timer.get()
+        if timer is not None:
+            timer.bytes += len(data)
+        await super().write(data)
+
+
+def render_metrics():
+    """Render route, upstream pool and limiter metrics in the Prometheus text format."""
+    lines = []
+
+    def metric(name, kind, help_text):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    totals = sorted(route_metrics.collect().items())
+    metric('trampoline_requests_total', 'counter', 'Requests served, by route and response status.')
+    for route, series in totals:
+        for status, count in sorted(series.statuses.items()):
+            lines.append(f'trampoline_requests_total{{route="{route}",status="{status}"}} {count}')
+    for name, attr, help_text in (
+        ('trampoline_upstream_seconds', 'upstream', 'Time a request spent waiting on upstream.'),
+        ('trampoline_proxy_seconds', 'proxy', 'Time a request spent in the trampoline itself.'),
+    ):
+        metric(name, 'histogram', help_text)
+        for route, series in totals:
+            cumulative = 0
+            for le, count in zip(LATENCY_BUCKET_LABELS, getattr(series, attr)):
+                cumulative += count
+                lines.append(f'{name}_bucket{{route="{route}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{route="{route}"}} {getattr(series, attr + "_sum"):.6f}')
+            lines.append(f'{name}_count{{route="{route}"}} {cumulative}')
+    metric('trampoline_in_flight_requests', 'gauge', 'Requests currently being served.')
+    for route, series in totals:
+        lines.append(f'trampoline_in_flight_requests{{route="{route}"}} {series.in_flight}')
+    metric('trampoline_response_bytes_total', 'counter', 'Response body bytes sent to clients.')
+    for route, series in totals:
+        lines.append(f'trampoline_response_bytes_total{{route="{route}"}} {series.bytes}')
+
+    pools = sorted(upstream.pool_stats().items())
+    metric('trampoline_upstream_connections', 'gauge', 'Pooled upstream connections, by state.')
+    for host, pool in pools:
+        for state in ('in_use', 'idle'):
+            lines.append(f'trampoline_upstream_connections{{host="{host}",state="{state}"}} {pool[state]}')
+    metric('trampoline_upstream_connection_limit', 'gauge', 'Most connections the pool will open.')
+    for host, pool in pools:
+        lines.append(f'trampoline_upstream_connection_limit{{host="{host}"}} {pool["limit"]}')
+    metric('trampoline_upstream_connection_waiters', 'gauge', 'Requests waiting for a free connection.')
+    for host, pool in pools:
+        lines.append(f'trampoline_upstream_connection_waiters{{host="{host}"}} {pool["waiting"]}')
+
+    limiters = sorted(dispatcher.stats().items())
+    for name, key, kind, help_text in (
+        ('trampoline_upstream_queued', 'queued', 'gauge', 'Requests queued by the host rate limiter.'),
+        ('trampoline_upstream_throttled_total', 'throttled', 'counter', 'Throttling responses from upstream.'),
+        ('trampoline_upstream_rejected_total', 'rejected', 'counter', 'Requests failed without calling upstream.'),
+        ('trampoline_upstream_retries_total', 'retries', 'counter', 'Requests retried after a connection error.'),
+        ('trampoline_upstream_circuit_open', 'circuit_open', 'gauge', 'Whether the circuit breaker is open.'),
+    ):
+        metric(name, kind, help_text)
+        for host, stats in limiters:
+            lines.append(f'{name}{{host="{host}"}} {int(stats[key])}')
+    watches = sorted(watch_hub.stats().items())
+    metric('trampoline_watches', 'gauge', 'Resources polled upstream for watching clients.')
+    for kind, stats in watches:
+        lines.append(f'trampoline_watches{{kind="{kind}"}} {stats["watches"]}')
+    metric('trampoline_watch_subscribers', 'gauge', 'Clients subscribed to watched resources.')
+    for kind, stats in watches:
+        lines.append(f'trampoline_watch_subscribers{{kind="{kind}"}} {stats["subscribers"]}')
+    hedges = hedger.stats()
+    for name, key, help_text in (
+        ('trampoline_upstream_hedges_total', 'hedged', 'Hedge requests sent.'),
+        ('trampoline_upstream_hedge_wins_total', 'wins', 'Hedge requests that answered first.'),
+        ('trampoline_upstream_hedges_skipped_total', 'skipped', 'Hedges not sent for lack of budget or health.'),
+    ):
+        metric(name, 'counter', help_text)
+        lines.append(f'{name} {hedges[key]}')
+    lines.append('')
+    return '\n'.join(lines)
+
+
+# When true, JSON routes forward the upstream bytes verbatim instead of
+# parsing and re-serializing them.
+JSON_PASSTHROUGH = True
+
+# Upstream response headers relayed to the client along with the body.
+RELAY_HEADERS = ('Content-Type', 'Content-Length', 'Content-Encoding', 'Retry-After')
+
+
+def json_loads(data):
+    """Parse JSON from bytes or str, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(value):
+    """Serialize ``value`` to compact JSON bytes, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode()
+
+def decode_body(body, content_encoding):
+    """Undo an upstream Content-Encoding (gzip, deflate or br)."""
+    if not content_encoding or content_encoding == 'identity':
+        return body
+    if content_encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if content_encoding == 'deflate':
+        return zlib.decompress(body)
+    if content_encoding == 'br' and brotli is not None:
+        return brotli.decompress(body)
+    raise ValueError(f'Unsupported Content-Encoding: {content_encoding}')
+
+
+class UpstreamResponse(namedtuple('UpstreamResponse', 'status headers body etag', defaults=(None,))):
+    """An upstream reply whose body is kept exactly as received.
+
+    The body may still be content-encoded; it is only decoded when a
+    caller actually needs to look inside it. ``etag`` is the validator given
+    to clients: upstream's own ETag, or one computed from the body.
+    """
+    __slots__ = ()
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
-
-        return (response, status_code, {'Content-Type': content_type})
-    elif request.method == 'PUT':
-        """Update project data on Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/projects/{project_id}'
-        headers = get_xtoken_header(request)
-        response = requests.put(scratch_api_url, headers=headers, json=request.json)
-        return (response.text, response.status_code, {'Content-Type': response.headers.get('Content-Type')})
-
-@app.route('/studios/<int:studioid>', methods=['GET', 'OPTIONS'])
-def get_studio(studioid):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/studios/{studioid}'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+    @property
+    def content_type(self):
+        return self.headers.get('Content-Type')
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+    def decoded(self):
+        return decode_body(self.body, self.headers.get('Content-Encoding'))
 
-        return (response, status_code, {'Content-Type': content_type})
+    def json(self):
+        return json_loads(self.decoded())
 
-@app.route('/studios/<int:studioid>/activity', methods=['GET', 'OPTIONS'])
-def get_studio_activity(studioid):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        if request.args.get('dateLimit'):
-            datelimit = "?dateLimit=" + request.args.get('dateLimit')
-        else:
-            datelimit = ""
-        scratch_api_url = f'https://api.scratch.mit.edu/studios/{studioid}/activity{datelimit}'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
+
+def accepts_encoding(accept_encoding, coding):
+    """Whether an Accept-Encoding header value allows ``coding``.
+
+    An entry naming ``coding`` decides, wherever it appears; ``*`` only
+    applies when there is none.
+    """
+    wildcard = False
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if name in (coding, '*'):
+            allowed = params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+            if name == coding:
+                return allowed
+            wildcard = allowed
+    return wildcard
+
+def upstream_encoding(accept_encoding):
+    """The Accept-Encoding to send upstream for a client's Accept-Encoding.
+
+    Narrowed to gzip or identity so JSON bodies can always be decoded when
+    needed and cached responses come in at most two variants.
+    """
+    return 'gzip' if accepts_encoding(accept_encoding, 'gzip') else 'identity'
+
+def relay_headers(response, names=RELAY_HEADERS):
+    """Headers from an upstream response to send back to the client."""
+    headers = {name: response.headers[name] for name in names if name in response.headers}
+    if getattr(response, 'etag', None):
+        headers['ETag'] = response.etag
+    if 'Content-Encoding' in headers:
+        headers['Vary'] = 'Accept-Encoding'
+    return headers
+
+def make_etag(body):
+    """A strong ETag for a response body."""
+    return '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+
+def variant_key(response, *extra):
+    """A cache key for something derived from ``response``'s body.
+
+    The upstream ETag alone won't do: responses fetched with different
+    tokens can carry the same ETag and still differ, so the key includes a
+    digest of the body itself.
+    """
+    return (hashlib.blake2b(response.body, digest_size=16).digest(), response.etag, *extra)
+
+def etag_matches(etag, if_none_match):
+    """Whether an If-None-Match header value matches ``etag`` (weak comparison)."""
+    if not etag or not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    etag = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+def not_modified_headers(response):
+    """Headers for a 304 Not Modified answer standing in for ``response``."""
+    headers = {'ETag': response.etag}
+    if 'Content-Encoding' in response.headers:
+        headers['Vary'] = 'Accept-Encoding'
+    return headers
+
+
+async def send_upstream(url, method='GET', family=None, **kwargs):
+    """Send one request upstream and return the aiohttp response with its body unread.
+
+    The request waits its turn with the host's limiter, is bounded by the
+    family's UPSTREAM_TIMEOUTS and is retried after a jittered backoff on
+    connection errors that allow it. Returns (response, retry_after) where
+    retry_after is the hold-off the limiter took from a 429 or 503.
+    """
+    limiter = dispatcher.limiter(upstream.host_for(url))
+    session = upstream.session_for(url)
+    for retry in range(CONNECT_RETRIES + 1):
+        queued = time.perf_counter()
+        await limiter.acquire(upstream_priority.get())
+        add_phase('queue', time.perf_counter() - queued)
+        try:
+            response = await session.request(method, url, timeout=upstream_timeout(family, method), **kwargs)
+        except (ClientError, asyncio.TimeoutError) as exc:
+            if retry == CONNECT_RETRIES or not retryable(exc, method):
+                limiter.record_failure()
+                raise
+            limiter.retries += 1
+            await asyncio.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** retry))
         else:
-            header = {
-                'x-token': xtoken
-            }
+            return response, limiter.record(response.status, response.headers)
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+async def fetch_raw(url, method='GET', headers=None, cookies=None, json=None, data=None, family=None):
+    """Send a request upstream and return an UpstreamResponse without decoding the body.
 
-        return (response, status_code, {'Content-Type': content_type})
+    The request body is ``json`` serialized, or ``data`` sent as it is, which
+    may be an async iterable of chunks to stream. GETs for HEDGED_FAMILIES
+    are hedged. A GET that is throttled with a short Retry-After is retried
+    once after the wait.
+    """
+    async def attempt():
+        for _ in range(2):
+            response, retry_after = await send_upstream(url, method, family, headers=headers, cookies=cookies,
+                                                        json=json, data=data)
+            reading = time.perf_counter()
+            try:
+                body = await response.read()
+            except (ClientError, asyncio.TimeoutError):
+                dispatcher.limiter(upstream.host_for(url)).record_failure()
+                raise
+            finally:
+                response.release()
+                add_phase('transfer', time.perf_counter() - reading)
+            if method != 'GET' or response.status != 429 or retry_after is None or retry_after > MAX_RETRY_AFTER_WAIT:
+                break
+        return UpstreamResponse(response.status, response.headers, body)
+
+    if method == 'GET' and family in HEDGED_FAMILIES:
+        return await hedger.run(upstream.host_for(url), family, attempt)
+    return await attempt()
+
+async def fetch_data(url, headers=None, cookies=None, family=None):
+    """Fetch data from a given URL with optional headers and cookies.
+    
+    Returns a tuple of (data, content_type, status) where data is the parsed
+    JSON response and content_type is the Content-Type header from the response.
+    """
+    response = await fetch_raw(url, headers=headers, cookies=cookies, family=family)
+    return response.json(), response.content_type, response.status
+
+class SingleFlight:
+    """Collapse concurrent identical upstream calls into one.
 
-@app.route('/studios/<int:studioid>/comments', methods=['GET', 'OPTIONS'])
-def get_studio_comments(studioid):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/studios/{studioid}/comments'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
+    The first caller for a key starts the call as its own task; callers that
+    arrive while it is still running wait on the same task and receive the
+    same result or exception. A waiter being cancelled does not cancel the
+    shared call. Must only be used from the upstream event loop.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._tasks = {}
+
+    async def do(self, key, call):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self.calls += 1
         else:
-            header = {
-                'x-token': xtoken
-            }
+            self.coalesced += 1
+        return await asyncio.shield(task)
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+    def _finish(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every waiter went away
 
-        return (response, status_code, {'Content-Type': content_type})
 
-@app.route('/studios/<int:studioid>/comments/<comment_id>', methods=['GET', 'OPTIONS'])
-def get_studio_comment(studioid, comment_id):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/studios/{studioid}/comments/{comment_id}'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+upstream_flights = SingleFlight()
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
 
-        return (response, status_code, {'Content-Type': content_type})
+async def fetch_json(url, headers=None, accept_encoding=None, stale=None, family=None):
+    """Fetch a JSON document to hand to a client as an UpstreamResponse.
 
-@app.route('/studios/<int:studioid>/comments/<comment_id>/replies', methods=['GET', 'OPTIONS'])
-def get_studio_comment_replies(studioid, comment_id):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/studios/{studioid}/comments/{comment_id}/replies'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+    With JSON_PASSTHROUGH the client's Accept-Encoding is forwarded and the
+    upstream bytes are returned untouched. Otherwise the body is parsed and
+    re-serialized, which is only useful for comparison. Successful responses
+    carry an ETag for the client.
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+    ``stale`` is an expired cached copy; if it has upstream validators the
+    request is made conditional and the copy is returned on a 304.
 
-        return (response, status_code, {'Content-Type': content_type})
+    Concurrent calls for the same URL, x-token and encoding share a single
+    upstream request. ``family`` is the route family, for timeouts and
+    hedging.
+    """
+    headers = dict(headers or {})
+    headers['Accept-Encoding'] = upstream_encoding(accept_encoding)
+    key = (url, headers.get('x-token'), headers['Accept-Encoding'])
+    return await upstream_flights.do(key, lambda: _fetch_json(url, headers, stale, family))
+
+async def _fetch_json(url, headers, stale, family):
+    if not JSON_PASSTHROUGH:
+        data, content_type, status = await fetch_data(url, headers=headers, family=family)
+        body = json.dumps(data).encode()
+        return UpstreamResponse(status, {'Content-Type': content_type or 'application/json',
+                                         'Content-Length': str(len(body))}, body, make_etag(body))
+    if stale is not None:
+        if 'ETag' in stale.headers:
+            headers['If-None-Match'] = stale.headers['ETag']
+        if 'Last-Modified' in stale.headers:
+            headers['If-Modified-Since'] = stale.headers['Last-Modified']
+    response = await fetch_raw(url, headers=headers, family=family)
+    if response.status == 304 and stale is not None:
+        return stale
+    if response.status == 200:
+        response = response._replace(etag=response.headers.get('ETag') or make_etag(response.body))
+    return response
 
-@app.route('/studios/<int:studioid>/curators', methods=['GET', 'OPTIONS'])
-def get_studio_curators(studioid):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/studios/{studioid}/curators'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+# Request headers forwarded upstream for images, and the response headers
+# relayed back, so clients can make range and conditional requests.
+IMAGE_FORWARD_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since')
+IMAGE_RELAY_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges',
+                       'ETag', 'Last-Modified', 'Cache-Control', 'Expires')
 
-        return (response, status_code, {'Content-Type': content_type})
 
-@app.route('/studios/<int:studioid>/managers', methods=['GET', 'OPTIONS'])
-def get_studio_managers(studioid):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/studios/{studioid}/managers'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+def image_request_headers(client_headers):
+    """Upstream request headers for an image fetch made on behalf of a client."""
+    headers = {name: client_headers[name] for name in IMAGE_FORWARD_HEADERS if name in client_headers}
+    headers['Accept-Encoding'] = 'identity'
+    return headers
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+async def open_stream(url, headers=None, family=None):
+    """Send a GET upstream and return the aiohttp response once headers arrive.
 
-        return (response, status_code, {'Content-Type': content_type})
+    The body is left unread so it can be streamed; the caller must release()
+    the response when done with it.
+    """
+    response, _ = await send_upstream(url, 'GET', family, headers=headers)
+    return response
 
-@app.route('/studios/<int:studioid>/projects', methods=['GET', 'OPTIONS'])
-def get_studio_projects(studioid):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/studios/{studioid}/projects'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+class StreamedBody:
+    """Iterate over the body of an open upstream response from a worker thread.
 
-        return (response, status_code, {'Content-Type': content_type})
+    Chunks are handed on as they arrive so a large body is never held in
+    memory at once. close(), called by the WSGI server when the response is
+    finished or abandoned, hands the connection back to the pool. Chunks are
+    also copied to ``cache_writer``, if given, which is committed to the
+    disk cache once the whole body has been read.
+    """
 
-@app.route('/users/<string:username>', methods=['GET', 'OPTIONS'])
-def get_user(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
+    def __init__(self, response, cache_writer=None):
+        self.response = response
+        self.cache_writer = cache_writer
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.response is None:
+            raise StopIteration
+        chunk = upstream.run(self.response.content.readany())
+        if not chunk:
+            if self.cache_writer is not None:
+                disk_cache_pool.submit(self.cache_writer.commit)
+                self.cache_writer = None
+            self.close()
+            raise StopIteration
+        if self.cache_writer is not None:
+            self.cache_writer.write(chunk)
+        return chunk
+
+    def close(self):
+        if self.cache_writer is not None:
+            self.cache_writer.abort()
+            self.cache_writer = None
+        if self.response is not None:
+            upstream.loop.call_soon_threadsafe(self.response.release)
+            self.response = None
+
+
+
+# Seconds a cached response stays fresh, per route family. Only routes
+# marked cache=True (or persist=True, for the disk cache) in ROUTES are
+# ever cached.
+CACHE_TTLS = {
+    'image': 86400,  # only kept on disk
+    'project': 30,
+    'studio': 60,
+    'user': 300,
+    'list': 60,
+    'comments': 30,
+    'activity': 10,
+}
+
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ResponseCache:
+    """A thread-safe LRU cache of UpstreamResponses bounded by total body size.
+
+    Each entry carries its own expiry time. Expired entries are no longer
+    returned by get() but are kept, until pushed out by newer ones, so that
+    stale() can offer them for revalidation upstream.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.revalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, response = entry
+            if expires <= time.monotonic():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def stale(self, key):
+        """Return the cached response for ``key`` even if it has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None else None
+
+    def put(self, key, response, ttl):
+        size = len(response.body)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                if self._entries[key][1] is response:
+                    self.revalidations += 1
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, response)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, response = self._entries.pop(key)
+        self.size -= len(response.body)
+
+    def discard(self, match):
+        """Drop every entry, fresh or expired, whose key satisfies ``match``."""
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'revalidations': self.revalidations,
             }
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
 
-        return (response, status_code, {'Content-Type': content_type})
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES)
 
 
-@app.route('/users/<string:username>/favorites', methods=['GET', 'OPTIONS'])
-def get_user_favorites(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/favorites'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+# Optional second cache tier on disk, enabled with --disk-cache. It survives
+# restarts and is shared by every trampoline process using the same
+# directory. Only routes marked persist=True in ROUTES use it, and only for
+# requests made without an x-token.
+DISK_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+DISK_CACHE_MAX_OBJECT_BYTES = 16 * 1024 * 1024
+DISK_CACHE_WORKERS = 2
+# Response headers kept with a body on disk.
+DISK_CACHE_HEADERS = ('Content-Type', 'Content-Length', 'Content-Encoding', 'ETag', 'Last-Modified',
+                      'Cache-Control', 'Expires')
+# Last-use times are only rewritten when older than this, so hits rarely write.
+DISK_CACHE_TOUCH_INTERVAL = 60
+# Idle connections to the index kept for reuse; Flask starts a thread per
+# request, so connections are pooled rather than kept per thread.
+DISK_CACHE_CONNECTIONS = 8
+# Attempts at switching a new index to WAL mode, which fails outright rather
+# than waiting while another process is creating it.
+DISK_CACHE_OPEN_ATTEMPTS = 20
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
 
-        return (response, status_code, {'Content-Type': content_type})
+DiskEntry = namedtuple('DiskEntry', 'path status headers etag size expires')
 
-@app.route('/users/<string:username>/followers', methods=['GET', 'OPTIONS'])
-def get_user_followers(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/followers'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+class DiskCache:
+    """An LRU cache of upstream responses on disk, shared between processes.
 
-        return (response, status_code, {'Content-Type': content_type})
+    Each body is a plain file under ``directory`` so it can be sent with
+    sendfile; an SQLite index (in WAL mode, which serializes writers across
+    processes) records its status, headers, ETag, expiry and last use.
+    Bodies are written to a temporary file and renamed into place under a
+    fresh name, never rewritten, so a reader that has a body open is not
+    disturbed when it is replaced or evicted. Entries are evicted least
+    recently used first to keep the bodies within ``max_bytes``. Expiry
+    times are wall-clock, since they are shared between processes.
+    """
 
-@app.route('/users/<string:username>/following', methods=['GET', 'OPTIONS'])
-def get_user_following(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/following'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bodies = os.path.join(directory, 'bodies')
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._idle = []  # pooled connections to the index
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        os.makedirs(self.bodies, exist_ok=True)
+        # A connection of its own, closed again, so none is left open to be
+        # inherited by forked workers.
+        with closing(self._connect()) as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, file TEXT NOT NULL, '
+                       'status INTEGER, headers TEXT, etag TEXT, size INTEGER, expires REAL, used REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+            db.execute('CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER)')
+            db.execute('INSERT OR IGNORE INTO totals VALUES (0, 0)')
+
+    def _connect(self):
+        # Pooled connections move between threads, one borrower at a time.
+        db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite3'), timeout=10, check_same_thread=False)
+        for attempt in range(DISK_CACHE_OPEN_ATTEMPTS):
+            try:
+                db.execute('PRAGMA journal_mode=WAL')
+                break
+            except sqlite3.OperationalError:
+                if attempt == DISK_CACHE_OPEN_ATTEMPTS - 1:
+                    db.close()
+                    raise
+                time.sleep(0.05)
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    @contextmanager
+    def _db(self):
+        """Borrow a connection to the index, opening one if none is idle."""
+        if self._pid != os.getpid():  # forked: connections must not be shared with the parent
+            self._idle, self._pid = [], os.getpid()
+        try:
+            db = self._idle.pop()
+        except IndexError:
+            db = self._connect()
+        try:
+            yield db
+        finally:
+            if len(self._idle) < DISK_CACHE_CONNECTIONS:
+                self._idle.append(db)
+            else:
+                db.close()
+
+    @staticmethod
+    def _key(key):
+        # Hashed so nothing identifying ends up in the index.
+        return hashlib.blake2b(json.dumps(key).encode(), digest_size=20).hexdigest()
+
+    def lookup(self, key):
+        """Return the DiskEntry for ``key``, expired or not, or None."""
+        digest = self._key(key)
+        with self._db() as db:
+            row = db.execute('SELECT file, status, headers, etag, size, expires, used FROM entries '
+                             'WHERE key = ?', (digest,)).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        name, status, headers, etag, size, expires, used = row
+        now = time.time()
+        if now - used > DISK_CACHE_TOUCH_INTERVAL:
+            with self._db() as db, db:
+                db.execute('UPDATE entries SET used = ? WHERE key = ?', (now, digest))
+        with self._lock:
+            self.hits += 1
+        return DiskEntry(os.path.join(self.bodies, name), status, json.loads(headers), etag, size, expires)
+
+    def get(self, key):
+        """Return (UpstreamResponse, expires) with the body read into memory, or None."""
+        entry = self.lookup(key)
+        if entry is None:
+            return None
+        try:
+            with open(entry.path, 'rb') as body_file:
+                body = body_file.read()
+        except FileNotFoundError:  # evicted by another process since the lookup
+            return None
+        return UpstreamResponse(entry.status, entry.headers, body, entry.etag), entry.expires
+
+    def put(self, key, response, ttl):
+        """Store an UpstreamResponse. An unchanged body only has its expiry extended."""
+        if len(response.body) > DISK_CACHE_MAX_OBJECT_BYTES:
+            return
+        digest = self._key(key)
+        with self._db() as db:
+            row = db.execute('SELECT etag FROM entries WHERE key = ?', (digest,)).fetchone()
+        if row is not None and row[0] is not None and row[0] == response.etag:
+            with self._db() as db, db:
+                db.execute('UPDATE entries SET expires = ?, used = ? WHERE key = ?',
+                           (time.time() + ttl, time.time(), digest))
+            return
+        writer = self.writer(key, response.status, response.headers, response.etag, ttl)
+        writer.write(response.body)
+        writer.commit()
+
+    def writer(self, key, status, headers, etag, ttl):
+        """Return a DiskCacheWriter to add a body to the cache as it streams in."""
+        return DiskCacheWriter(self, key, status, headers, etag, ttl)
+
+    def _commit(self, key, temp_path, status, headers, etag, size, ttl):
+        """Move a finished body file into place and index it, evicting as needed."""
+        digest = self._key(key)
+        name = f'{digest}-{os.path.basename(temp_path)[1:]}'
+        os.replace(temp_path, os.path.join(self.bodies, name))
+        headers = {header: headers[header] for header in DISK_CACHE_HEADERS if header in headers}
+        now = time.time()
+        removed = []
+        with self._db() as db, db:
+            db.execute('BEGIN IMMEDIATE')
+            old = db.execute('SELECT file, size FROM entries WHERE key = ?', (digest,)).fetchone()
+            if old is not None:
+                removed.append(old[0])
+                db.execute('UPDATE totals SET size = size - ?', (old[1],))
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (digest, name, status, json.dumps(headers), etag, size, now + ttl, now))
+            total = db.execute('SELECT size FROM totals').fetchone()[0] + size
+            while total > self.max_bytes:
+                victims = db.execute('SELECT key, file, size FROM entries WHERE key != ? ORDER BY used LIMIT 32',
+                                     (digest,)).fetchall()
+                if not victims:
+                    break
+                for victim_key, victim_file, victim_size in victims:
+                    if total <= self.max_bytes:
+                        break
+                    db.execute('DELETE FROM entries WHERE key = ?', (victim_key,))
+                    removed.append(victim_file)
+                    total -= victim_size
+            db.execute('UPDATE totals SET size = ?', (total,))
+        with self._lock:
+            self.stores += 1
+            self.evictions += len(removed) - (old is not None)
+        for name in removed:
+            try:
+                os.unlink(os.path.join(self.bodies, name))
+            except FileNotFoundError:
+                pass
+
+    def delete(self, key):
+        """Drop the entry for ``key``, if there is one."""
+        digest = self._key(key)
+        with self._db() as db, db:
+            db.execute('BEGIN IMMEDIATE')
+            old = db.execute('SELECT file, size FROM entries WHERE key = ?', (digest,)).fetchone()
+            if old is None:
+                return
+            db.execute('DELETE FROM entries WHERE key = ?', (digest,))
+            db.execute('UPDATE totals SET size = size - ?', (old[1],))
+        try:
+            os.unlink(os.path.join(self.bodies, old[0]))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        with self._db() as db:
+            entries, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {
+            'directory': self.directory,
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+        }
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
 
-        return (response, status_code, {'Content-Type': content_type})
+class DiskCacheWriter:
+    """Copies a body into a temporary file, then adds it to the DiskCache on commit().
 
-@app.route('/users/<string:username>/following/studios/projects', methods=['GET', 'OPTIONS'])
-def get_user_following_studio_projects(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/following/studios/projects'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+    Bodies that grow past DISK_CACHE_MAX_OBJECT_BYTES are dropped; so is
+    anything not committed, via abort().
+    """
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+    def __init__(self, cache, key, status, headers, etag, ttl):
+        self.cache = cache
+        self.key = key
+        self.status = status
+        self.headers = headers
+        self.etag = etag
+        self.ttl = ttl
+        self.size = 0
+        fd, self.path = tempfile.mkstemp(prefix='.', dir=cache.bodies)
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        if self.file is None:
+            return
+        self.size += len(chunk)
+        if self.size > DISK_CACHE_MAX_OBJECT_BYTES:
+            self.abort()
+            return
+        self.file.write(chunk)
+
+    def commit(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        try:
+            self.cache._commit(self.key, self.path, self.status, self.headers, self.etag, self.size, self.ttl)
+        except (OSError, sqlite3.Error):
+            self._unlink()
+            raise
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self._unlink()
+
+    def _unlink(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+disk_cache = None  # a DiskCache, when enabled with --disk-cache
+disk_cache_pool = ThreadPoolExecutor(max_workers=DISK_CACHE_WORKERS, thread_name_prefix='disk-cache')
+
+
+def uses_disk_cache(route, token):
+    """Whether requests for ``route`` made with x-token ``token`` go through the disk cache."""
+    return disk_cache is not None and route.persist and token is None
+
+# Headers sent with an image served from the disk cache, besides its type.
+CACHED_IMAGE_HEADERS = ('Cache-Control', 'Expires')
+
+def cached_image(route, url):
+    """The fresh disk cache entry for an image, or None."""
+    if not uses_disk_cache(route, None):
+        return None
+    entry = disk_cache.lookup((url, None, 'identity'))
+    return entry if entry is not None and entry.expires > time.time() else None
+
+def cached_image_file(route, url):
+    """cached_image(), but None if another process has evicted the body since.
+
+    FileResponse answers 404 rather than raising when its file is missing,
+    so the aiohttp server checks before handing the file over.
+    """
+    entry = cached_image(route, url)
+    return entry if entry is not None and os.path.isfile(entry.path) else None
 
-        return (response, status_code, {'Content-Type': content_type})
+def cached_image_headers(entry):
+    return {name: entry.headers[name] for name in CACHED_IMAGE_HEADERS if name in entry.headers}
 
-@app.route('/users/<string:username>/following/users/activity', methods=['GET', 'OPTIONS'])
-def get_user_following_activity(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/following/users/activity'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+def file_etag(path):
+    """The ETag aiohttp's FileResponse gives a file, so both servers agree on it."""
+    stat = os.stat(path)
+    return f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+def image_cache_writer(route, url, response):
+    """A DiskCacheWriter to keep an image streamed from cdn2, or None if it should not be kept.
 
-        return (response, status_code, {'Content-Type': content_type})
+    Only complete 200 responses are kept, so range and conditional
+    requests pass through untouched.
+    """
+    if not uses_disk_cache(route, None) or response.status != 200:
+        return None
+    cache_control = response.headers.get('Cache-Control', '')
+    if 'no-store' in cache_control or 'private' in cache_control:
+        return None
+    if int(response.headers.get('Content-Length') or 0) > DISK_CACHE_MAX_OBJECT_BYTES:
+        return None
+    return disk_cache.writer((url, None, 'identity'), response.status, response.headers,
+                             response.headers.get('ETag'), CACHE_TTLS['image'])
+
+
+def cache_lookup(route, url, headers, accept_encoding, disk=True):
+    """Look up a GET in the response cache, then the disk cache if it applies.
+
+    Returns (key, response, stale). The key is None when the route is never
+    cached. On a hit response is the fresh cached copy; on a miss it is None
+    and stale is any expired copy to revalidate. Entries are keyed on the
+    x-token so they are never shared between different users. With ``disk``
+    false the disk cache is left to the caller (see cache_lookup_async).
+    """
+    if not route.cache:
+        return None, None, None
+    key = (url, headers.get('x-token'), upstream_encoding(accept_encoding))
+    response = response_cache.get(key)
+    if response is not None:
+        return key, response, None
+    stale = response_cache.stale(key)
+    if disk and uses_disk_cache(route, key[1]):
+        response, stale = disk_lookup(key, stale)
+    return key, response, stale
+
+def disk_lookup(key, stale):
+    """Look up a response cache miss on disk, keeping a fresh entry in memory again.
+
+    Returns (response, stale) as for cache_lookup.
+    """
+    found = disk_cache.get(key)
+    if found is None:
+        return None, stale
+    response, expires = found
+    ttl = expires - time.time()
+    if ttl <= 0:
+        return None, stale or response
+    response_cache.put(key, response, ttl)
+    return response, None
+
+async def cache_lookup_async(route, url, headers, accept_encoding):
+    """cache_lookup for the event loop, reading the disk cache on disk_cache_pool."""
+    key, response, stale = cache_lookup(route, url, headers, accept_encoding, disk=False)
+    if response is None and uses_disk_cache(route, headers.get('x-token')):
+        response, stale = await asyncio.get_running_loop().run_in_executor(disk_cache_pool, disk_lookup,
+                                                                           key, stale)
+    return key, response, stale
+
+def cache_store(route, key, response):
+    """Cache a successful response fetched after a cache_lookup miss."""
+    if key is not None and response.status == 200:
+        ttl = CACHE_TTLS[route.family]
+        response_cache.put(key, response, ttl)
+        if uses_disk_cache(route, key[1]):
+            disk_cache_pool.submit(disk_cache.put, key, response, ttl)
+
+def invalidate_cached(route, url):
+    """Drop every cached copy of ``url``, for every token, after a write changed it upstream.
+
+    Blocks on the disk cache; aiohttp handlers run it on disk_cache_pool.
+    """
+    if not route.cache:
+        return
+    response_cache.discard(lambda key: key[0] == url)
+    if uses_disk_cache(route, None):
+        for encoding in ('gzip', 'identity'):
+            disk_cache.delete((url, None, encoding))
+
+
+# Responses smaller than this are sent as they are.
+COMPRESS_MIN_BYTES = 1024
+COMPRESSION_WORKERS = 2
+COMPRESSED_CACHE_MAX_BYTES = 16 * 1024 * 1024
+# Variants are keyed by body digest, so they never go stale; the TTL only bounds
+# how long a variant nobody asks for can linger.
+COMPRESSED_VARIANT_TTL = 3600
+
+compression_pool = ThreadPoolExecutor(max_workers=COMPRESSION_WORKERS, thread_name_prefix='compress')
+compressed_variants = ResponseCache(COMPRESSED_CACHE_MAX_BYTES)
+
+
+def preferred_encoding(accept_encoding):
+    """The best Content-Encoding we can produce for an Accept-Encoding value."""
+    if brotli is not None and accepts_encoding(accept_encoding, 'br'):
+        return 'br'
+    if accepts_encoding(accept_encoding, 'gzip'):
+        return 'gzip'
+    return None
+
+def compression_for(response, accept_encoding):
+    """The encoding ``response`` must be converted to for this client, or None to send it as is."""
+    if response.status != 200 or response.etag is None or len(response.body) < COMPRESS_MIN_BYTES:
+        return None
+    content_type = response.content_type or ''
+    if 'json' not in content_type and not content_type.startswith('text/'):
+        return None
+    coding = preferred_encoding(accept_encoding)
+    if coding is None or coding == response.headers.get('Content-Encoding', 'identity'):
+        return None
+    return coding
+
+def encode_variant(response, coding):
+    """Re-encode a response body with ``coding``.
+
+    CPU bound: the event loop hands it to compression_pool, while Flask
+    request threads run it themselves.
+    """
+    body = response.decoded()
+    if coding == 'br':
+        body = brotli.compress(body, quality=5)
+    else:
+        body = gzip.compress(body, compresslevel=6, mtime=0)
+    headers = {
+        'Content-Type': response.content_type,
+        'Content-Length': str(len(body)),
+        'Content-Encoding': coding,
+    }
+    # A strong ETag has to differ between encodings of the same resource.
+    return UpstreamResponse(response.status, headers, body, f'{response.etag[:-1]}-{coding}"')
 
-@app.route('/users/<string:username>/following/users/loves', methods=['GET', 'OPTIONS'])
-def get_user_following_loves(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/following/users/loves'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+def negotiate(response, accept_encoding):
+    """Return the variant of ``response`` to send to a client, compressing it if needed.
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+    Compressed variants of hot responses are kept in compressed_variants so
+    each one is only compressed once.
+    """
+    coding = compression_for(response, accept_encoding)
+    if coding is None:
+        return response
+    key = variant_key(response, coding)
+    variant = compressed_variants.get(key)
+    if variant is None:
+        variant = encode_variant(response, coding)
+        compressed_variants.put(key, variant, COMPRESSED_VARIANT_TTL)
+    return variant
+
+async def negotiate_async(response, accept_encoding):
+    """negotiate() for code running on an event loop."""
+    coding = compression_for(response, accept_encoding)
+    if coding is None:
+        return response
+    key = variant_key(response, coding)
+    variant = compressed_variants.get(key)
+    if variant is None:
+        loop = asyncio.get_running_loop()
+        variant = await loop.run_in_executor(compression_pool, encode_variant, response, coding)
+        compressed_variants.put(key, variant, COMPRESSED_VARIANT_TTL)
+    return variant
+
+def cache_stats_report():
+    """Counters for the response cache, with the variant and disk stores nested in."""
+    stats = response_cache.stats()
+    stats['compressed'] = compressed_variants.stats()
+    stats['projected'] = projected_variants.stats()
+    stats['images'] = derived_images.stats()
+    if disk_cache is not None:
+        stats['disk'] = disk_cache.stats()
+    return stats
+
+
+MAX_FIELDS = 50  # paths accepted in one fields= parameter
+PROJECTED_CACHE_MAX_BYTES = 16 * 1024 * 1024
+# Like compressed variants, projections are keyed by the body they came from.
+PROJECTED_VARIANT_TTL = 3600
+# Projections of bodies smaller than this are made on the event loop rather
+# than handed to compression_pool.
+PROJECT_INLINE_BYTES = 16 * 1024
+
+projected_variants = ResponseCache(PROJECTED_CACHE_MAX_BYTES)
+
+
+class Projection:
+    """A parsed fields= parameter: the members to keep from JSON objects.
+
+    ``fields`` is a comma-separated list of member names, with dots reaching
+    into nested objects: 'title,stats.loves,image'. Lists are projected
+    item by item, so the same fields apply to each project of a list page
+    or to each element of a nested list. Members a value does not have are
+    left out rather than reported.
+    """
 
-        return (response, status_code, {'Content-Type': content_type})
+    def __init__(self, fields):
+        paths = sorted({path.strip() for path in fields.split(',') if path.strip()})
+        if not paths:
+            raise ValueError('fields must name at least one field')
+        if len(paths) > MAX_FIELDS:
+            raise ValueError(f'fields may name at most {MAX_FIELDS} fields')
+        self.tree = {}
+        for path in paths:
+            names = path.split('.')
+            if not all(names):
+                raise ValueError(f'Invalid field: {path!r}')
+            node = self.tree
+            for name in names[:-1]:
+                node = node.setdefault(name, {})
+                if node is True:  # the whole parent is already selected
+                    break
+            else:
+                node[names[-1]] = True
+        # Identifies the projection in variant cache keys and ETags.
+        self.key = ','.join(paths)
+        self.digest = hashlib.blake2b(self.key.encode(), digest_size=6).hexdigest()
+
+    def apply(self, value, tree=None):
+        """The projection of a decoded JSON value."""
+        tree = self.tree if tree is None else tree
+        if isinstance(value, list):
+            return [self.apply(item, tree) for item in value]
+        if not isinstance(value, dict):
+            return value
+        return {name: value[name] if selected is True else self.apply(value[name], selected)
+                for name, selected in tree.items() if name in value}
+
+    def encode(self, value):
+        """Project a decoded JSON value and serialize it.
+
+        A list is serialized one item at a time, so the projected copy of a
+        large page is never held next to the decoded one.
+        """
+        if isinstance(value, list):
+            return b'[' + b','.join(json_dumps(self.apply(item)) for item in value) + b']'
+        return json_dumps(self.apply(value))
+
+
+def fields_option(args):
+    """The Projection for the fields= query argument, or None without one.
+
+    Raises ValueError for a malformed value.
+    """
+    fields = args.get('fields')
+    return None if fields is None else Projection(fields)
 
-@app.route('/users/<string:username>/following/users/projects', methods=['GET', 'OPTIONS'])
-def get_user_following_projects(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/following/users/loves'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+def projectable(response):
+    return response.status == 200 and response.etag is not None and 'json' in (response.content_type or '')
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+def project_variant(response, projection):
+    """Build the projection of ``response``. CPU bound, like encode_variant."""
+    body = projection.encode(response.json())
+    headers = {'Content-Type': response.content_type, 'Content-Length': str(len(body))}
+    return UpstreamResponse(200, headers, body, f'{response.etag[:-1]}-f{projection.digest}"')
 
-        return (response, status_code, {'Content-Type': content_type})
+def project(response, projection):
+    """Return ``response`` with only the fields a projection selects.
 
-@app.route('/users/<string:username>/messages/count', methods=['GET', 'OPTIONS'])
-def get_user_message_count(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/messages/count'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+    Projected variants of hot responses are kept in projected_variants, so
+    a popular fields= combination is only decoded and re-encoded once per
+    upstream body. Anything but a 200 JSON response is returned as is, and
+    so is a body that does not parse, just as it would be without fields=.
+    """
+    if projection is None or not projectable(response):
+        return response
+    key = variant_key(response, projection.key)
+    variant = projected_variants.get(key)
+    if variant is None:
+        try:
+            variant = project_variant(response, projection)
+        except (ValueError, zlib.error):
+            return response
+        projected_variants.put(key, variant, PROJECTED_VARIANT_TTL)
+    return variant
+
+async def project_async(response, projection):
+    """project() for code running on an event loop."""
+    if projection is None or not projectable(response):
+        return response
+    key = variant_key(response, projection.key)
+    variant = projected_variants.get(key)
+    if variant is None:
+        try:
+            if len(response.body) < PROJECT_INLINE_BYTES:
+                variant = project_variant(response, projection)
+            else:
+                loop = asyncio.get_running_loop()
+                variant = await loop.run_in_executor(compression_pool, project_variant, response, projection)
+        except (ValueError, zlib.error):
+            return response
+        projected_variants.put(key, variant, PROJECTED_VARIANT_TTL)
+    return variant
+
+
+# Resized and re-encoded images (?w=, ?h=, ?format= on the image route) are
+# made with Pillow in image_pool and kept in derived_images, and on disk
+# when the disk cache is enabled, so each variant is only made once.
+IMAGE_WORKERS = 2
+MAX_IMAGE_DIMENSION = 2048
+DERIVED_IMAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# format= value -> (Pillow format, Content-Type, save options)
+IMAGE_FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 85, 'optimize': True}),
+    'png': ('PNG', 'image/png', {}),
+}
+
+ImageVariant = namedtuple('ImageVariant', 'width height format')
+
+image_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='image')
+derived_images = ResponseCache(DERIVED_IMAGE_CACHE_MAX_BYTES)
+image_flights = SingleFlight()
+
+
+def image_variant(args):
+    """The ImageVariant asked for by w, h and format query args, or None for the original.
+
+    Raises ValueError for bad values.
+    """
+    if not any(name in args for name in ('w', 'h', 'format')):
+        return None
+    size = []
+    for name in ('w', 'h'):
+        try:
+            value = int(args[name]) if name in args else None
+        except ValueError:
+            raise ValueError(f'{name} must be an integer') from None
+        if value is not None and not 1 <= value <= MAX_IMAGE_DIMENSION:
+            raise ValueError(f'{name} must be between 1 and {MAX_IMAGE_DIMENSION}')
+        size.append(value)
+    fmt = args.get('format')
+    if fmt is not None and fmt not in IMAGE_FORMATS:
+        raise ValueError(f'format must be one of {", ".join(IMAGE_FORMATS)}')
+    return ImageVariant(*size, fmt)
+
+def render_image(source, variant):
+    """Resize and re-encode an image. CPU bound; runs in image_pool.
+
+    The image is scaled down to fit within the width and height, keeping its
+    aspect ratio, and never scaled up. Without a format the source's own is
+    kept where it is one of IMAGE_FORMATS.
+    """
+    with Image.open(io.BytesIO(source.body)) as image:
+        fmt = variant.format or (image.format or '').lower()
+        if fmt not in IMAGE_FORMATS:
+            fmt = 'png'
+        pil_format, content_type, options = IMAGE_FORMATS[fmt]
+        box = (variant.width or image.width, variant.height or image.height)
+        image.draft(image.mode, box)  # lets JPEG decode at a reduced scale
+        image.thumbnail(box, Image.Resampling.LANCZOS)
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, pil_format, **options)
+    body = output.getvalue()
+    headers = {'Content-Type': content_type, 'Content-Length': str(len(body))}
+    if 'Cache-Control' in source.headers:
+        headers['Cache-Control'] = source.headers['Cache-Control']
+    return UpstreamResponse(200, headers, body, make_etag(body))
+
+def image_error(status, message):
+    body = json_dumps({'error': message})
+    return UpstreamResponse(status, {'Content-Type': 'application/json', 'Content-Length': str(len(body))}, body)
+
+async def derived_image(route, url, variant):
+    """Return a resized or re-encoded image as an UpstreamResponse.
+
+    Variants come from derived_images, the disk cache, or are made from the
+    original fetched in full from cdn2; concurrent requests for a variant
+    share one fetch and one encode. Failures come back as JSON error
+    responses, which are not cached.
+    """
+    key = (url, None, 'identity') + tuple(variant)
+    response = derived_images.get(key)
+    if response is None:
+        response = await image_flights.do(key, lambda: make_derived_image(route, url, variant, key))
+    return response
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+async def make_derived_image(route, url, variant, key):
+    loop = asyncio.get_running_loop()
+    ttl = CACHE_TTLS['image']
+    if uses_disk_cache(route, None):
+        found = await loop.run_in_executor(disk_cache_pool, disk_cache.get, key)
+        if found is not None and found[1] > time.time():
+            response, expires = found
+            derived_images.put(key, response, expires - time.time())
+            return response
+    source = await fetch_raw(url, headers={'Accept-Encoding': 'identity'}, family=route.family)
+    if source.status != 200:
+        return image_error(source.status, 'Failed to fetch data')
+    try:
+        response = await loop.run_in_executor(image_pool, render_image, source, variant)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return image_error(502, 'Failed to process image')
+    derived_images.put(key, response, ttl)
+    if uses_disk_cache(route, None):
+        disk_cache_pool.submit(disk_cache.put, key, response, ttl)
+    return response
 
-        return (response, status_code, {'Content-Type': content_type})
+# Request headers forwarded upstream with a write, besides the x-token.
+WRITE_FORWARD_HEADERS = ('Content-Type', 'Content-Length')
+WRITE_CHUNK_BYTES = 64 * 1024
+# Responses to writes sent with an Idempotency-Key header are kept this long
+# (seconds) and replayed to a retry of the same write instead of sending it
+# upstream again.
+IDEMPOTENCY_TTL = 3600
+IDEMPOTENCY_CACHE_MAX_BYTES = 8 * 1024 * 1024
+# Sent instead of a replay when a key is reused for a different body.
+IDEMPOTENCY_MISMATCH = UpstreamResponse(
+    422, {'Content-Type': 'application/json'},
+    b'{"error": "Idempotency-Key has already been used for a different request body"}')
 
-@app.route('/users/<string:username>/messages', methods=['GET', 'OPTIONS'])
-def get_user_messages(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/messages'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+idempotent_responses = ResponseCache(IDEMPOTENCY_CACHE_MAX_BYTES)
+write_flights = SingleFlight()
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
 
-        return (response, status_code, {'Content-Type': content_type})
+class KeptWrite(namedtuple('KeptWrite', 'response digest')):
+    """A write's response kept under its Idempotency-Key, with the digest of the body sent."""
+
+    @property
+    def body(self):  # what ResponseCache counts
+        return self.response.body
 
-@app.route('/users/<string:username>/projects', methods=['GET', 'OPTIONS'])
-def get_user_projects(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/projects'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+class BodyDigest:
+    """Hashes a write body as it streams upstream, so a retry can be checked against it.
 
-        return (response, status_code, {'Content-Type': content_type})
+    ``body`` is what to send in place of the original: an async iterator of
+    bytes or an aiohttp StreamReader, or None. ``complete`` turns true once
+    every byte has gone through.
+    """
 
-@app.route('/users/<string:username>/projects/recentlyviewed', methods=['GET', 'OPTIONS'])
-def get_user_projects_recentlyviewed(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/projects/recentlyviewed'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
+    def __init__(self, body):
+        self._hash = hashlib.blake2b(digest_size=16)
+        self.complete = body is None
+        self.body = None if body is None else self._chunks(body)
+
+    async def _chunks(self, body):
+        chunks = body.iter_chunked(WRITE_CHUNK_BYTES) if hasattr(body, 'iter_chunked') else body
+        async for chunk in chunks:
+            self._hash.update(chunk)
+            yield chunk
+        self.complete = True
+
+    def digest(self):
+        return self._hash.digest()
+
+    async def read(self):
+        """Hash the rest of a body that is not being sent, and return the digest."""
+        if self.body is not None:
+            async for _ in self.body:
+                pass
+        return self.digest()
+
+
+def write_headers(client_headers, headers):
+    """Add the headers a write forwards from the client to its upstream ``headers``."""
+    headers['Accept-Encoding'] = client_headers.get('Accept-Encoding', 'identity')
+    for name in WRITE_FORWARD_HEADERS:
+        if name in client_headers:
+            headers[name] = client_headers[name]
+    headers.setdefault('Content-Type', 'application/json')
+    return headers
+
+async def iter_wsgi_body(stream):
+    """Read a WSGI request body in chunks, off the upstream loop, to stream it upstream."""
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, stream.read, WRITE_CHUNK_BYTES)
+        if not chunk:
+            return
+        yield chunk
+
+async def send_write(url, method, headers, body, family, idempotency_key=None):
+    """Forward a PUT or POST upstream, streaming ``body`` rather than buffering it.
+
+    Returns (response, replayed). With an ``idempotency_key`` the response is
+    kept, per x-token and URL, for IDEMPOTENCY_TTL: a client retrying a write
+    after timing out gets it back (replayed is true) instead of posting again,
+    and a retry arriving while the first attempt is still in flight waits for
+    it. Only definite answers are kept, not 429s, 5xx or failures to reach
+    upstream, so those can still be retried. A retry is read through and
+    compared with the body first sent; reusing a key for a different body
+    gets a 422. Keyed writes ask upstream for an unencoded response, since it
+    may be replayed to clients accepting different encodings.
+    """
+    if idempotency_key is None:
+        return await fetch_raw(url, method, headers=headers, data=body, family=family), False
+    headers['Accept-Encoding'] = 'identity'
+    key = (method, url, headers.get('x-token'), idempotency_key)
+    streamed = BodyDigest(body)
+    sent = False
+
+    async def send():
+        nonlocal sent
+        sent = True
+        response = await fetch_raw(url, method, headers=headers, data=streamed.body, family=family)
+        kept = KeptWrite(response, streamed.digest())
+        # Not kept if upstream answered before reading the whole body: there
+        # would be nothing to compare a retry's body with.
+        if response.status < 500 and response.status != 429 and streamed.complete:
+            idempotent_responses.put(key, kept, IDEMPOTENCY_TTL)
+        return kept
+    kept = idempotent_responses.get(key)
+    if kept is None:
+        kept = await write_flights.do(key, send)
+        if sent:
+            return kept.response, False
+    if await streamed.read() != kept.digest:
+        return IDEMPOTENCY_MISMATCH, False
+    return kept.response, True
+
+def write_response_headers(response, replayed):
+    headers = relay_headers(response)
+    if replayed:
+        headers['Idempotent-Replayed'] = 'true'
+    return headers
+
+# Query parameters that select a page; dropped when fanning out with ?all=1.
+PAGING_PARAMS = ('limit', 'offset')
+PAGE_SIZE = 40  # the largest limit the Scratch API accepts
+PAGINATION_CONCURRENCY = 4  # pages in flight at once per fan-out
+MAX_FANOUT_ITEMS = 2000  # hard cap on items returned by one fan-out
+
+FANOUT_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+
+class PageFetchError(Exception):
+    """A page of a paginated upstream list did not come back as a 200 JSON list."""
+
+    def __init__(self, response, offset):
+        super().__init__(f'page at offset {offset} returned {response.status}')
+        self.response = response
+        self.offset = offset
+
+
+# Stands in for a 200 page that is not a JSON list, so it is reported like
+# any other failed page.
+BAD_PAGE_RESPONSE = UpstreamResponse(502, {'Content-Type': 'application/json'}, b'{"error": "Failed to fetch data"}')
+
+
+def fanout_requested(args):
+    """Whether the query args ask for every page: ?all=1 or ?all=true, but not ?all=0 or ?all=false."""
+    return args.get('all', '').lower() in ('1', 'true', 'yes')
+
+def fanout_options(args):
+    """Read max_items and format from the query args of an ?all=1 request.
+
+    Returns (max_items, format), or raises ValueError for bad values.
+    """
+    max_items = min(int(args.get('max_items', MAX_FANOUT_ITEMS)), MAX_FANOUT_ITEMS)
+    if max_items < 1:
+        raise ValueError('max_items must be at least 1')
+    fmt = args.get('format', 'ndjson')
+    if fmt not in FANOUT_CONTENT_TYPES:
+        raise ValueError(f'format must be one of {", ".join(FANOUT_CONTENT_TYPES)}')
+    return max_items, fmt
+
+async def iter_all_pages(url, headers, max_items, family):
+    """Yield the pages of a paginated upstream list, in order, as lists of items.
+
+    Up to PAGINATION_CONCURRENCY pages are fetched at once. Fetching stops
+    at the first short page or once max_items items have been yielded.
+    """
+    separator = '&' if '?' in url else '?'
+
+    async def fetch_page(offset):
+        upstream_priority.set(PRIORITY_BULK)
+        page_url = f'{url}{separator}limit={PAGE_SIZE}&offset={offset}'
+        response = await fetch_json(page_url, headers=headers, accept_encoding='gzip', family=family)
+        if response.status != 200:
+            raise PageFetchError(response, offset)
+        try:
+            page = response.json()
+        except (ValueError, zlib.error):
+            page = None
+        if not isinstance(page, list):  # an error object, or not JSON at all
+            raise PageFetchError(BAD_PAGE_RESPONSE, offset)
+        return page
+
+    pending = deque()
+    next_offset = 0
+    remaining = max_items
+
+    def schedule():
+        nonlocal next_offset
+        pending.append(asyncio.ensure_future(fetch_page(next_offset)))
+        next_offset += PAGE_SIZE
+
+    try:
+        while len(pending) < PAGINATION_CONCURRENCY and next_offset < max_items:
+            schedule()
+        while pending:
+            page = await pending.popleft()
+            yield page[:remaining]
+            remaining -= min(len(page), remaining)
+            if len(page) < PAGE_SIZE or remaining == 0:
+                break
+            if next_offset < max_items:
+                schedule()
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def encode_pages(first_page, pages, fmt, projection=None):
+    """Serialize pages from iter_all_pages as NDJSON lines or one JSON array.
+
+    With a projection each item is projected as its page is serialized, so
+    only one page is held at a time. An upstream error after streaming has
+    begun cannot change the status code, so it is reported in-band and ends
+    the stream.
+    """
+    def items(page):
+        return (json_dumps(item if projection is None else projection.apply(item)) for item in page)
+
+    try:
+        if fmt == 'ndjson':
+            yield b''.join(item + b'\n' for item in items(first_page))
+            async for page in pages:
+                yield b''.join(item + b'\n' for item in items(page))
         else:
-            header = {
-                'x-token': xtoken
-            }
+            yield b'[' + b','.join(items(first_page))
+            separator = b',' if first_page else b''
+            async for page in pages:
+                if page:
+                    yield separator + b','.join(items(page))
+                    separator = b','
+            yield b']'
+    except PageFetchError as exc:
+        error = {'error': 'Failed to fetch data', 'status': exc.response.status, 'offset': exc.offset}
+        yield json_dumps(error) + b'\n'
+    except UpstreamUnavailable as exc:
+        yield json_dumps({'error': str(exc), 'status': 503}) + b'\n'
+    except (ClientError, asyncio.TimeoutError) as exc:
+        error, status = failure_response(exc)
+        yield json_dumps({**error, 'status': status}) + b'\n'
+    finally:
+        await pages.aclose()
+
+
+# --- route table ---------------------------------------------------------
+
+WRITE_METHODS = ('PUT', 'POST')
+
+
+def compile_path(template):
+    """Precompile an upstream path template such as '/projects/{project_id}'.
+
+    Returns a function building the path from a mapping of route arguments,
+    each percent-encoded so it cannot escape its path segment.
+    """
+    pieces = [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+    def build(args):
+        return ''.join(literal + (quote(str(args[field]), safe='') if field else '')
+                       for literal, field in pieces)
+    return build
 
-        return (response, status_code, {'Content-Type': content_type})
 
-@app.route('/users/<string:username>/projects/<int:projectid>/studios', methods=['GET', 'OPTIONS'])
-def get_project_studios(username, projectid):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/projects/{projectid}/studios'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
+class Route:
+    """One proxied route and the policy that applies to it.
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+    ``path`` is the trampoline URL rule and ``upstream`` the path template on
+    the ``host`` named in UPSTREAM_HOSTS. ``family`` groups routes for
+    per-family settings such as cache TTLs. ``cache`` allows caching of
+    responses and ``persist`` keeps them in the disk cache too, when one is
+    configured. ``paginated`` enables ?all=1, ``auth`` requires an x-token
+    and ``query`` lists the query parameters forwarded upstream. ``kind`` is
+    'json' for ordinary routes, or 'image' / 'session' for the two routes
+    that need special handling.
+    """
 
-        return (response, status_code, {'Content-Type': content_type})
+    def __init__(self, name, path, host, upstream, family, methods=('GET',), cache=False, persist=False,
+                 paginated=False, auth=False, query=(), kind='json'):
+        self.name = name
+        self.path = path
+        self.host = host
+        self.upstream = upstream
+        self.family = family
+        self.methods = methods
+        self.cache = cache
+        self.persist = persist
+        self.paginated = paginated
+        self.auth = auth
+        self.query = query
+        self.kind = kind
+        self._build_path = compile_path(upstream)
+
+    def url(self, args, query_args=None, paging=True):
+        """The upstream URL for the given route arguments and client query args.
+
+        Only the parameters named in ``query`` are forwarded; with
+        ``paging`` false, limit and offset are dropped as well.
+        """
+        url = UPSTREAM_HOSTS[self.host] + self._build_path(args)
+        if query_args:
+            query = [(name, query_args[name]) for name in self.query
+                     if name in query_args and (paging or name not in PAGING_PARAMS)]
+            if query:
+                url += '?' + urlencode(query)
+        return url
+
+
+ROUTES = [
+    Route('get_project', '/projects/<int:project_id>', 'api', '/projects/{project_id}', 'project',
+          methods=('GET', 'PUT'), cache=True, persist=True),
+    Route('get_project_remixes', '/projects/<int:project_id>/remixes', 'api', '/projects/{project_id}/remixes', 'list',
+          cache=True, paginated=True, query=PAGING_PARAMS),
+    Route('get_project_loves', '/projects/<int:project_id>/loves/user/<string:username>', 'api',
+          '/projects/{project_id}/loves/user/{username}', 'user_status', auth=True),
+    Route('get_project_favorites', '/projects/<int:project_id>/favorites/user/<string:username>', 'api',
+          '/projects/{project_id}/favorites/user/{username}', 'user_status', auth=True),
+    Route('proxy_comments', '/proxy/comments/project/<int:project_id>', 'api', '/proxy/comments/project/{project_id}',
+          'write', methods=('POST',), auth=True),
+
+    Route('get_studio', '/studios/<int:studioid>', 'api', '/studios/{studioid}', 'studio', cache=True),
+    Route('get_studio_activity', '/studios/<int:studioid>/activity', 'api', '/studios/{studioid}/activity', 'activity',
+          cache=True, query=('dateLimit',) + PAGING_PARAMS),
+    Route('get_studio_comments', '/studios/<int:studioid>/comments', 'api', '/studios/{studioid}/comments', 'comments',
+          cache=True, query=PAGING_PARAMS),
+    Route('get_studio_comment', '/studios/<int:studioid>/comments/<comment_id>', 'api',
+          '/studios/{studioid}/comments/{comment_id}', 'comments', cache=True),
+    Route('get_studio_comment_replies', '/studios/<int:studioid>/comments/<comment_id>/replies', 'api',
+          '/studios/{studioid}/comments/{comment_id}/replies', 'comments', cache=True, query=PAGING_PARAMS),
+    Route('get_studio_curators', '/studios/<int:studioid>/curators', 'api', '/studios/{studioid}/curators', 'list',
+          cache=True, paginated=True, query=PAGING_PARAMS),
+    Route('get_studio_managers', '/studios/<int:studioid>/managers', 'api', '/studios/{studioid}/managers', 'list',
+          cache=True, paginated=True, query=PAGING_PARAMS),
+    Route('get_studio_projects', '/studios/<int:studioid>/projects', 'api', '/studios/{studioid}/projects', 'list',
+          cache=True, paginated=True, query=PAGING_PARAMS),
+
+    Route('get_user', '/users/<string:username>', 'api', '/users/{username}', 'user', cache=True),
+    Route('get_user_favorites', '/users/<string:username>/favorites', 'api', '/users/{username}/favorites', 'list',
+          cache=True, paginated=True, query=PAGING_PARAMS),
+    Route('get_user_followers', '/users/<string:username>/followers', 'api', '/users/{username}/followers', 'list',
+          cache=True, paginated=True, query=PAGING_PARAMS),
+    Route('get_user_following', '/users/<string:username>/following', 'api', '/users/{username}/following', 'list',
+          cache=True, paginated=True, query=PAGING_PARAMS),
+    Route('get_user_projects', '/users/<string:username>/projects', 'api', '/users/{username}/projects', 'list',
+          cache=True, paginated=True, query=PAGING_PARAMS),
+    Route('get_project_studios', '/users/<string:username>/projects/<int:projectid>/studios', 'api',
+          '/users/{username}/projects/{projectid}/studios', 'list', cache=True, paginated=True, query=PAGING_PARAMS),
+    Route('get_user_projects_recentlyviewed', '/users/<string:username>/projects/recentlyviewed', 'api',
+          '/users/{username}/projects/recentlyviewed', 'feed', auth=True, query=PAGING_PARAMS),
+    Route('get_user_following_studio_projects', '/users/<string:username>/following/studios/projects', 'api',
+          '/users/{username}/following/studios/projects', 'feed', auth=True, query=PAGING_PARAMS),
+    Route('get_user_following_activity', '/users/<string:username>/following/users/activity', 'api',
+          '/users/{username}/following/users/activity', 'feed', auth=True, query=PAGING_PARAMS),
+    Route('get_user_following_loves', '/users/<string:username>/following/users/loves', 'api',
+          '/users/{username}/following/users/loves', 'feed', auth=True, query=PAGING_PARAMS),
+    Route('get_user_following_projects', '/users/<string:username>/following/users/projects', 'api',
+          '/users/{username}/following/users/projects', 'feed', auth=True, query=PAGING_PARAMS),
+    Route('get_user_message_count', '/users/<string:username>/messages/count', 'api',
+          '/users/{username}/messages/count', 'messages'),
+    Route('get_user_messages', '/users/<string:username>/messages', 'api', '/users/{username}/messages', 'messages',
+          auth=True, query=PAGING_PARAMS + ('filter',)),
+    Route('get_user_message_admin', '/users/<string:username>/messages/admin', 'api',
+          '/users/{username}/messages/admin', 'messages', auth=True),
+
+    Route('get_image_cdn2', '/cdn2/get_image/project/<string:image>', 'cdn2', '/get_image/project/{image}', 'image',
+          persist=True, kind='image'),
+    Route('session', '/session', 'site', '/session', 'session', kind='session'),
+]
+
+ROUTES_BY_NAME = {route.name: route for route in ROUTES}
 
-@app.route('/users/<string:username>/messages/admin', methods=['GET', 'OPTIONS'])
-def get_user_message_admin(username):
-    if request.method == 'GET':
-        """Fetch project data from Scratch API."""
-        scratch_api_url = f'https://api.scratch.mit.edu/users/{username}/messages/admin'
-        xtoken = request.headers.get('x-token', None)
-        if not xtoken:
-            header = {}
-        else:
-            header = {
-                'x-token': xtoken
-            }
 
-        # Forward the request to the Scratch API
-        response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=header))
-        #response = requests.get(scratch_api_url)
+app = Flask(__name__)
 
-        return (response, status_code, {'Content-Type': content_type})
+@app.before_request
+def start_request_timer():
+    request_timer.set(route_metrics.start(request.endpoint, request.method, request.path))
 
-@app.route('/projects/<int:project_id>/loves/user/<string:username>', methods=['GET', 'OPTIONS'])
-def get_project_loves(project_id, username):
-    """Fetch project data from Scratch API."""
-    scratch_api_url = f'https://api.scratch.mit.edu/projects/{project_id}/loves/user/{username}'
-    
-    # Forward the request to the Scratch API
-    response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers={'x-token': request.headers.get('x-token')}))
-    #response = requests.get(scratch_api_url)
+@app.after_request
+def record_request_metrics(response):
+    """Record the request in route_metrics once its body has been sent."""
+    timer = request_timer.get()
+    if timer is None:
+        return response
+    timer.status = response.status_code
+    if response.is_streamed and not response.direct_passthrough:
+        response.response = MeteredBody(response.response, timer)
+    else:
+        timer.bytes = response.calculate_content_length() or 0
+    response.call_on_close(functools.partial(finish_request, timer))
+    return response
 
-    return (response, status_code, {'Content-Type': content_type})
+@app.after_request
+def add_server_timing(response):
+    """Break the time taken down in a Server-Timing header, with --server-timing."""
+    timer = request_timer.get()
+    if SERVER_TIMING and timer is not None:
+        response.headers['Server-Timing'] = server_timing(timer)
+    return response
 
-@app.route('/projects/<int:project_id>/remixes', methods=['GET', 'OPTIONS'])
-def get_project_remixes(project_id):
-    """Fetch project data from Scratch API."""
-    scratch_api_url = f'https://api.scratch.mit.edu/projects/{project_id}/remixes'
-    
-    # Forward the request to the Scratch API
-    headers = get_xtoken_header(request)
-    response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers=headers))
-    #response = requests.get(scratch_api_url)
-
-    return (response, status_code, {'Content-Type': content_type})
-
-@app.route('/proxy/comments/project/<int:project_id>', methods=['POST', 'OPTIONS'])
-def proxy_comments(project_id):
-    """Proxy the request to the Scratch API."""
-    scratch_api_url = f'https://api.scratch.mit.edu/proxy/comments/project/{project_id}'
-    response = requests.post(scratch_api_url, headers={'x-token': request.headers.get('x-token')}, json=request.json)
-    return (response.text, response.status_code, {'Content-Type': response.headers.get('Content-Type')})
-
-@app.route('/projects/<int:project_id>/favorites/user/<string:username>', methods=['GET', 'OPTIONS'])
-def get_project_favorites(project_id, username):
-    """Fetch project data from Scratch API."""
-    scratch_api_url = f'https://api.scratch.mit.edu/projects/{project_id}/favorites/user/{username}'
-    
-    # Forward the request to the Scratch API
-    response, content_type, status_code = asyncio.run(fetch_data(scratch_api_url, headers={'x-token': request.headers.get('x-token')}))
-    #response = requests.get(scratch_api_url)
+@app.after_request
+def add_cors_headers(response):
+    """Add CORS headers to all responses."""
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,Idempotency-Key')
+    response.headers.add('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+    return response
 
-    return (response, status_code, {'Content-Type': content_type})
-    
-@app.route('/cdn2/get_image/project/<string:image>', methods=['GET', 'OPTIONS'])
-def get_image_cdn2(image):
-    """Fetch project data from Scratch API."""
-    scratch_api_url = f'https://cdn2.scratch.mit.edu/get_image/project/{image}'
-    
-    # Forward the request to the Scratch API
-    response = requests.get(scratch_api_url)
-    
-    if response.ok:  # Check if the request was successful
-        # Create a new response object
-        return (response.content, response.status_code, {'Content-Type': response.headers.get('Content-Type')})
+def unavailable_response(exc):
+    """Body and headers of the 503 sent when an UpstreamUnavailable is raised."""
+    return {'error': str(exc)}, {'Retry-After': str(math.ceil(exc.retry_after))}
+
+@app.errorhandler(UpstreamUnavailable)
+def upstream_unavailable(exc):
+    body, headers = unavailable_response(exc)
+    return jsonify(body), 503, headers
+
+def failure_response(exc):
+    """Body and status sent when an upstream request fails (502) or times out (504)."""
+    if isinstance(exc, asyncio.TimeoutError):
+        return {'error': 'Upstream timed out'}, 504
+    return {'error': 'Failed to fetch data'}, 502
+
+@app.errorhandler(ClientError)
+@app.errorhandler(asyncio.TimeoutError)
+def upstream_failed(exc):
+    body, status = failure_response(exc)
+    return jsonify(body), status
+
+def get_xtoken_header(request):
+    xtoken = request.headers.get('x-token', None)
+    if not xtoken:
+        header = {}
     else:
-        return jsonify({'error': 'Failed to fetch data'}), response.status_code
+        header = {
+            'x-token': xtoken
+        }
+    return header
+
+def proxy_json(route, url, headers, projection=None):
+    """Proxy a JSON GET for the current request, passing the upstream bytes through.
+
+    With a fields= projection the body is decoded, projected and re-encoded
+    instead; the full response is still what gets cached.
+    """
+    accept_encoding = request.headers.get('Accept-Encoding')
+    key, response, stale = cache_lookup(route, url, headers, accept_encoding)
+    if response is None:
+        response = upstream.run(fetch_json(url, headers=headers, accept_encoding=accept_encoding, stale=stale,
+                                           family=route.family))
+        cache_store(route, key, response)
+    response = negotiate(project(response, projection), accept_encoding)
+    if response.status == 200 and etag_matches(response.etag, request.headers.get('If-None-Match')):
+        return ('', 304, not_modified_headers(response))
+    return (response.body, response.status, relay_headers(response))
+
+class UpstreamIterator:
+    """Drive an async iterator on the upstream loop from a worker thread."""
+
+    def __init__(self, iterator):
+        self.iterator = iterator
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.iterator is None:
+            raise StopIteration
+        try:
+            return upstream.run(self.iterator.__anext__())
+        except StopAsyncIteration:
+            self.iterator = None
+            raise StopIteration
+
+    def close(self):
+        if self.iterator is not None:
+            upstream.run(self.iterator.aclose())
+            self.iterator = None
+
+def proxy_all_pages(url, headers, family, projection=None):
+    """Stream every page of a paginated list for the current ?all=1 request."""
+    try:
+        max_items, fmt = fanout_options(request.args)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    pages = iter_all_pages(url, headers, max_items, family)
+    try:
+        first_page = upstream.run(pages.__anext__())
+    except PageFetchError as exc:
+        upstream.run(pages.aclose())
+        return (exc.response.body, exc.response.status, relay_headers(exc.response))
+    except BaseException:
+        upstream.run(pages.aclose())  # stop the prefetches of later pages
+        raise
+    body = UpstreamIterator(encode_pages(first_page, pages, fmt, projection))
+    return Response(body, status=200, content_type=FANOUT_CONTENT_TYPES[fmt])
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Report response cache hit/miss/eviction counters."""
+    return jsonify(cache_stats_report())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Expose request and upstream metrics for Prometheus."""
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+def proxy_write(route, url, headers):
+    """Forward a PUT or POST to the Scratch API, streaming the request body through.
+
+    A successful write drops the cached copies of what it changed.
+    """
+    has_body = request.content_length or 'chunked' in request.headers.get('Transfer-Encoding', '')
+    body = iter_wsgi_body(request.stream) if has_body else None
+    response, replayed = upstream.run(send_write(url, request.method, write_headers(request.headers, headers), body,
+                                                 route.family, request.headers.get('Idempotency-Key')))
+    if 200 <= response.status < 300:
+        invalidate_cached(route, url)
+    return (response.body, response.status, write_response_headers(response, replayed))
+
+def proxy_image(route, url):
+    """Stream an image from cdn2, relaying range and conditional responses.
+
+    With the disk cache, a cached image is sent from its file (with sendfile
+    where the WSGI server supports it) and an image fetched in full is kept.
+    With w, h or format (and Pillow installed) a derived image is sent
+    instead.
+    """
+    try:
+        variant = image_variant(request.args)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    if variant is not None and Image is not None:
+        response = upstream.run(derived_image(route, url, variant))
+        if response.status == 200 and etag_matches(response.etag, request.headers.get('If-None-Match')):
+            return ('', 304, not_modified_headers(response))
+        return (response.body, response.status, relay_headers(response, IMAGE_RELAY_HEADERS))
+    entry = cached_image(route, url)
+    if entry is not None:
+        try:
+            return cached_image_response(entry)
+        except FileNotFoundError:  # evicted by another process since the lookup
+            pass
+    response = upstream.run(open_stream(url, headers=image_request_headers(request.headers), family=route.family))
     
-@app.route('/session', methods=['GET', 'OPTIONS'])
-def session():
-    """Fetch project data from Scratch API."""
-    scratch_api_url = f'https://scratch.mit.edu/session'
+    if response.status < 400:  # Check if the request was successful
+        # Stream the image (or relay a 206/304) as it arrives
+        return Response(StreamedBody(response, image_cache_writer(route, url, response)), status=response.status,
+                        headers=relay_headers(response, IMAGE_RELAY_HEADERS))
+    else:
+        upstream.loop.call_soon_threadsafe(response.release)
+        return jsonify({'error': 'Failed to fetch data'}), response.status
+
+def cached_image_response(entry):
+    """Send an image from the disk cache, leaving ranges and conditionals to send_file."""
+    headers = cached_image_headers(entry)
+    if etag_matches(entry.etag, request.headers.get('If-None-Match')):
+        return ('', 304, {'ETag': entry.etag, **headers})
+    response = send_file(entry.path, mimetype=entry.headers.get('Content-Type'), conditional=True,
+                         etag=file_etag(entry.path))
+    response.headers.update(headers)
+    return response
+
+def proxy_session(url, family):
+    """Fetch the scratch.mit.edu session for the client's cookies."""
     header = {
-        'x-requested-with': 'XMLHttpRequest'
+        'x-requested-with': 'XMLHttpRequest',
+        'Accept-Encoding': request.headers.get('Accept-Encoding', 'identity'),
     }
-    
-    # Forward the request to the Scratch API
-    response = requests.get(scratch_api_url, headers=header, cookies=request.cookies)
-    
-    return (response.content, response.status_code, {'Content-Type': response.headers.get('Content-Type')})
+    response = upstream.run(fetch_raw(url, headers=header, cookies=request.cookies, family=family))
+    return (response.body, response.status, relay_headers(response))
+
+def proxy_route(route, args):
+    """Handle the current request for ``route`` with the given path arguments."""
+    headers = get_xtoken_header(request)
+    if (route.auth or request.method in WRITE_METHODS) and not headers:
+        return jsonify({'error': 'x-token header required'}), 401
+    fan_out = route.paginated and fanout_requested(request.args)
+    url = route.url(args, request.args, paging=not fan_out)
+
+    if route.kind == 'image':
+        return proxy_image(route, url)
+    if route.kind == 'session':
+        return proxy_session(url, route.family)
+    if request.method in WRITE_METHODS:
+        return proxy_write(route, url, headers)
+    try:
+        projection = fields_option(request.args)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    if fan_out:
+        return proxy_all_pages(url, headers, route.family, projection)
+    return proxy_json(route, url, headers, projection)
+
+def flask_view(route):
+    """Build the Flask view function for a route from the table."""
+    def view(**args):
+        return proxy_route(route, args)
+    view.__name__ = route.name
+    view.__doc__ = f'Proxy {route.path} to {route.upstream} on {route.host}.'
+    return view
+
+for route in ROUTES:
+    app.add_url_rule(route.path, endpoint=route.name, view_func=flask_view(route), methods=route.methods)
+
+
+# --- batch ---------------------------------------------------------------
+
+MAX_BATCH_REQUESTS = 100
+BATCH_CONCURRENCY = 8
+MAX_BATCH_CONCURRENCY = 32
+BATCH_TIMEOUT = 10  # seconds for the whole batch
+MAX_BATCH_TIMEOUT = 30
+
+
+def parse_batch(payload):
+    """Validate a /batch request body.
+
+    Returns (paths, concurrency, timeout, stream), or raises ValueError.
+    """
+    if not isinstance(payload, dict) or not isinstance(payload.get('requests'), list):
+        raise ValueError('body must be a JSON object with a "requests" list')
+    paths = payload['requests']
+    if len(paths) > MAX_BATCH_REQUESTS:
+        raise ValueError(f'at most {MAX_BATCH_REQUESTS} requests per batch')
+    if not all(isinstance(path, str) and path.startswith('/') for path in paths):
+        raise ValueError('each request must be a path starting with "/"')
+    concurrency = min(int(payload.get('concurrency', BATCH_CONCURRENCY)), MAX_BATCH_CONCURRENCY)
+    timeout = min(float(payload.get('timeout', BATCH_TIMEOUT)), MAX_BATCH_TIMEOUT)
+    if concurrency < 1 or timeout <= 0:
+        raise ValueError('concurrency and timeout must be positive')
+    return paths, concurrency, timeout, bool(payload.get('stream'))
+
+def resolve_batch_path(path):
+    """Match a batched path against the route table.
+
+    Returns (route, upstream URL, projection), or (None, None, None) when the
+    path is not a proxied JSON GET route. Raises ValueError for a malformed
+    fields= argument.
+    """
+    parts = urlsplit(path)
+    try:
+        endpoint, args = app.url_map.bind('localhost').match(parts.path, method='GET')
+    except HTTPException:
+        return None, None, None
+    route = ROUTES_BY_NAME.get(endpoint)
+    if route is None or route.kind != 'json':
+        return None, None, None
+    query_args = {name: values[0] for name, values in parse_qs(parts.query).items()}
+    return route, route.url(args, query_args), fields_option(query_args)
+
+async def fetch_batch_item(path, headers):
+    """Fetch one batched path, returning (status, JSON body bytes)."""
+    try:
+        route, url, projection = resolve_batch_path(path)
+    except ValueError as exc:
+        return 400, json_dumps({'error': str(exc)})
+    if url is None:
+        return 404, b'{"error": "Unknown route"}'
+    if route.auth and not headers:
+        return 401, b'{"error": "x-token header required"}'
+    key, response, stale = await cache_lookup_async(route, url, headers, 'gzip')
+    if response is None:
+        response = await fetch_json(url, headers=headers, accept_encoding='gzip', stale=stale, family=route.family)
+        cache_store(route, key, response)
+    response = await project_async(response, projection)
+    body = response.decoded()
+    if 'json' not in (response.content_type or ''):
+        body = json.dumps(body.decode('utf-8', 'replace')).encode()
+    else:
+        # The body is spliced into the batch as it is, so one that does not
+        # parse would corrupt every other item's result too.
+        json_loads(body)
+    return response.status, body
+
+async def iter_batch(paths, headers, concurrency, timeout):
+    """Yield (index, path, status, body) for each path as its fetch completes.
+
+    At most ``concurrency`` fetches run at once. Paths still unfinished after
+    ``timeout`` seconds are cancelled and reported with status 504.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index, path):
+        upstream_priority.set(PRIORITY_BULK)
+        async with semaphore:
+            try:
+                status, body = await fetch_batch_item(path, headers)
+            except UpstreamUnavailable as exc:
+                status, body = 503, json.dumps({'error': str(exc)}).encode()
+            except (ClientError, asyncio.TimeoutError, ValueError, zlib.error) as exc:
+                # ValueError: the body is not valid JSON; zlib.error: it did not decompress.
+                error, status = failure_response(exc)
+                body = json.dumps(error).encode()
+        return index, path, status, body
+
+    tasks = [asyncio.ensure_future(run(index, path)) for index, path in enumerate(paths)]
+    finished = set()
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=timeout):
+            try:
+                result = await next_done
+            except asyncio.TimeoutError:
+                break
+            finished.add(result[0])
+            yield result
+        for index, path in enumerate(paths):
+            if index not in finished:
+                yield index, path, 504, b'{"error": "Timed out"}'
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def batch_item_json(index, path, status, body):
+    """One batch result as JSON, splicing in the already-encoded body."""
+    head = json.dumps({'index': index, 'path': path, 'status': status})
+    return head[:-1].encode() + b', "body": ' + body + b'}'
+
+async def collect_batch(results):
+    """Gather every batch result into one JSON document, in request order."""
+    items = sorted([item async for item in results])
+    return b'{"responses": [' + b', '.join(batch_item_json(*item) for item in items) + b']}'
+
+async def encode_batch_lines(results):
+    """Serialize batch results as NDJSON lines in completion order."""
+    try:
+        async for item in results:
+            yield batch_item_json(*item) + b'\n'
+    finally:
+        await results.aclose()
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """Run many proxied GETs concurrently and return every response at once."""
+    try:
+        paths, concurrency, timeout, stream = parse_batch(request.get_json(silent=True))
+    except (TypeError, ValueError) as exc:
+        return jsonify({'error': str(exc)}), 400
+    results = iter_batch(paths, get_xtoken_header(request), concurrency, timeout)
+    if stream:
+        return Response(UpstreamIterator(encode_batch_lines(results)), content_type='application/x-ndjson')
+    return (upstream.run(collect_batch(results)), 200, {'Content-Type': 'application/json'})
+
+
+# --- watch ---------------------------------------------------------------
+#
+# Clients that used to poll studio activity or a user's message count can
+# subscribe to a Server-Sent Events stream instead. Each watched resource is
+# polled upstream by one task however many clients watch it, and only the
+# changes since the previous poll are pushed to them.
+
+WATCH_INTERVALS = {'activity': 10, 'messages': 15}  # seconds between upstream polls
+WATCH_KEEPALIVE = 15  # seconds of silence before a comment line keeps a stream open
+WATCH_QUEUE_SIZE = 32  # events held for a slow subscriber before it is resynced
+MAX_WATCHES = 1000  # distinct resources polled at once per process
+WATCH_RETRY = 30  # seconds before polling again after the host turned us away
+
+
+def activity_changes(previous, current):
+    """Events for a new page of studio activity: the items not seen before, newest first."""
+    seen = {item.get('id') for item in previous}
+    added = [item for item in current if item.get('id') not in seen]
+    return [('activity', added)] if added else []
+
+def count_changes(previous, current):
+    """Events for a new message count: the count, whenever it changed."""
+    return [('count', current)] if current != previous else []
+
+def is_activity(body):
+    return isinstance(body, list) and all(isinstance(item, dict) for item in body)
+
+def is_count(body):
+    return isinstance(body, dict)
+
+# Watchable resource kind -> (route polled, route argument, expected body
+# shape, change detector). Activity is polled for its newest page and diffed
+# by item id: upstream's dateLimit pages backwards in time, so it cannot ask
+# for newer items only.
+WATCH_KINDS = {
+    'activity': ('get_studio_activity', 'studioid', is_activity, activity_changes),
+    'messages': ('get_user_message_count', 'username', is_count, count_changes),
+}
+
+
+class Watch:
+    """One upstream resource, polled for every client subscribed to it."""
+
+    def __init__(self, kind, target):
+        route_name, arg, self.valid, self.changes = WATCH_KINDS[kind]
+        self.route = ROUTES_BY_NAME[route_name]
+        self.url = self.route.url({arg: target}, {'limit': PAGE_SIZE})
+        self.interval = WATCH_INTERVALS[kind]
+        self.subscribers = set()
+        self.response = None  # last 200 from upstream, sent back as ``stale`` to poll conditionally
+        self.snapshot = None
+        self.task = None
+
+    def publish(self, event):
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # The client fell behind; replace its backlog with the current state.
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(('snapshot', self.snapshot))
+
+    async def poll(self):
+        """Fetch the resource once and publish what changed. Returns seconds to wait for the next poll."""
+        try:
+            response = await fetch_json(self.url, accept_encoding='gzip', stale=self.response,
+                                        family=self.route.family)
+        except UpstreamUnavailable as exc:
+            return max(exc.retry_after, self.interval)
+        except (ClientError, asyncio.TimeoutError):
+            return WATCH_RETRY
+        if response.status != 200 or response is self.response:
+            return self.interval
+        self.response = response
+        try:
+            current = response.json()
+        except ValueError:
+            return self.interval
+        if not self.valid(current):
+            return self.interval
+        if self.snapshot is None:
+            events = [('snapshot', current)]
+        else:
+            events = self.changes(self.snapshot, current)
+        self.snapshot = current
+        for event in events:
+            self.publish(event)
+        return self.interval
+
+    async def run(self):
+        upstream_priority.set(PRIORITY_BULK)
+        request_timer.set(None)  # polls belong to no one request
+        while True:
+            try:
+                delay = await self.poll()
+            except Exception:
+                # Keep watching: a task that died here would leave its
+                # subscribers connected with nothing ever arriving.
+                traceback.print_exc()
+                delay = WATCH_RETRY
+            await asyncio.sleep(delay)
+
+
+class WatchHub:
+    """The watches of this process, created on first subscription and stopped after the last.
+
+    Lives on the upstream event loop; every method must be called there.
+    """
+
+    def __init__(self, max_watches=MAX_WATCHES):
+        self.max_watches = max_watches
+        self._watches = {}
+
+    def accepting(self, kind, target):
+        """Whether a new subscriber to a resource would be let in. Safe to call from any thread."""
+        return (kind, target) in self._watches or len(self._watches) < self.max_watches
+
+    def subscribe(self, kind, target):
+        """Start receiving events for a resource.
+
+        Returns the queue events arrive on, or None when this process is
+        already watching as many resources as it may. A subscriber joining
+        a running watch is sent the current snapshot straight away.
+        """
+        key = (kind, target)
+        watch = self._watches.get(key)
+        if watch is None:
+            if not self.accepting(kind, target):
+                return None
+            watch = self._watches[key] = Watch(kind, target)
+            watch.task = asyncio.ensure_future(watch.run())
+        queue = asyncio.Queue(WATCH_QUEUE_SIZE)
+        if watch.snapshot is not None:
+            queue.put_nowait(('snapshot', watch.snapshot))
+        watch.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, kind, target, queue):
+        key = (kind, target)
+        watch = self._watches.get(key)
+        if watch is None:
+            return
+        watch.subscribers.discard(queue)
+        if not watch.subscribers:
+            watch.task.cancel()
+            del self._watches[key]
+
+    def stats(self):
+        """Resources watched and subscribers, by kind."""
+        stats = {kind: {'watches': 0, 'subscribers': 0} for kind in WATCH_KINDS}
+        for (kind, _), watch in list(self._watches.items()):
+            stats[kind]['watches'] += 1
+            stats[kind]['subscribers'] += len(watch.subscribers)
+        return stats
+
+
+watch_hub = WatchHub()
+
+
+WATCH_HEADERS = {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+WATCH_LIMIT_ERROR = {'error': 'Too many watched resources, try again later'}
+
+async def watch_events(kind, target):
+    """Subscribe to a resource and serialize its events as a Server-Sent Events stream.
+
+    The subscription starts when the stream is first read and ends when it
+    is closed, which is how a client going away stops being sent events.
+    """
+    queue = watch_hub.subscribe(kind, target)
+    if queue is None:  # the limit was reached after accepting() was checked
+        yield b'event: error\ndata: ' + json_dumps(WATCH_LIMIT_ERROR) + b'\n\n'
+        return
+    try:
+        yield b'retry: %d\n\n' % (WATCH_INTERVALS[kind] * 1000)
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), WATCH_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield b': keepalive\n\n'
+                continue
+            yield b'event: ' + event.encode() + b'\ndata: ' + json_dumps(data) + b'\n\n'
+    finally:
+        watch_hub.unsubscribe(kind, target, queue)
+
+def proxy_watch(kind, target):
+    """Stream changes to a watched resource to the current client."""
+    target = str(target)
+    if not watch_hub.accepting(kind, target):
+        return jsonify(WATCH_LIMIT_ERROR), 503
+    if request.method == 'HEAD':
+        return Response(headers=WATCH_HEADERS)
+    return Response(UpstreamIterator(watch_events(kind, target)), headers=WATCH_HEADERS)
+
+@app.route('/studios/<int:studioid>/activity/watch', methods=['GET'])
+def watch_studio_activity(studioid):
+    """Push new studio activity as Server-Sent Events."""
+    return proxy_watch('activity', studioid)
+
+@app.route('/users/<string:username>/messages/count/watch', methods=['GET'])
+def watch_message_count(username):
+    """Push a user's message count as Server-Sent Events whenever it changes."""
+    return proxy_watch('messages', username)
+
+# --- aiohttp server mode -------------------------------------------------
+#
+# The same URL surface as the Flask app above, served natively on asyncio so
+# a single process can hold many in-flight upstream calls at once. Routes are
+# derived from the Flask url_map and the route table so the two modes cannot
+# drift apart.
+
+def _aiohttp_path(rule):
+    """Convert a Flask rule such as /projects/<int:project_id> to aiohttp syntax."""
+    def convert(match):
+        converter, name = match.group(1), match.group(2)
+        if converter == 'int':
+            return '{%s:\\d+}' % name
+        return '{%s}' % name
+    return re.sub(r'<(?:(\w+):)?(\w+)>', convert, rule)
+
+def _aiohttp_response(response):
+    """Turn an UpstreamResponse into an aiohttp response with the relayed headers."""
+    return web.Response(body=response.body, status=response.status, headers=relay_headers(response))
+
+@web.middleware
+async def aiohttp_record_metrics(request, handler):
+    """Record each request in route_metrics, like the Flask request hooks."""
+    timer = route_metrics.start(request.match_info.route.name, request.method, request.path)
+    request_timer.set(timer)
+    request['timer'] = timer
+    try:
+        response = await handler(request)
+    except web.HTTPException as exc:
+        timer.status = exc.status
+        raise
+    else:
+        timer.status = response.status
+        if not response.prepared:  # streamed responses count their bytes as they write them
+            timer.bytes = response.content_length or 0
+        return response
+    finally:
+        finish_request(timer)
+
+@web.middleware
+async def aiohttp_upstream_errors(request, handler):
+    """Turn upstream errors into 502, 503 and 504 responses, like the Flask error handlers."""
+    try:
+        return await handler(request)
+    except UpstreamUnavailable as exc:
+        body, headers = unavailable_response(exc)
+        return web.json_response(body, status=503, headers=headers)
+    except (ClientError, asyncio.TimeoutError) as exc:
+        body, status = failure_response(exc)
+        return web.json_response(body, status=status)
+
+async def aiohttp_cors_headers(request, response):
+    """Add the same CORS headers as add_cors_headers to every response.
+
+    Runs as an on_response_prepare signal so streamed responses and errors
+    get the headers before they are sent.
+    """
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization,Idempotency-Key'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+    timer = request.get('timer')
+    if SERVER_TIMING and timer is not None:
+        response.headers['Server-Timing'] = server_timing(timer)
+
+async def aiohttp_image(request, route, url):
+    """Stream an image from cdn2, relaying range and conditional responses."""
+    try:
+        variant = image_variant(request.query)
+    except ValueError as exc:
+        return web.json_response({'error': str(exc)}, status=400)
+    if variant is not None and Image is not None:
+        response = await upstream_wait(derived_image(route, url, variant))
+        if response.status == 200 and etag_matches(response.etag, request.headers.get('If-None-Match')):
+            return web.Response(status=304, headers=not_modified_headers(response))
+        return web.Response(body=response.body, status=response.status,
+                            headers=relay_headers(response, IMAGE_RELAY_HEADERS))
+    if uses_disk_cache(route, None):
+        entry = await asyncio.get_running_loop().run_in_executor(disk_cache_pool, cached_image_file, route, url)
+        if entry is not None:
+            headers = cached_image_headers(entry)
+            if etag_matches(entry.etag, request.headers.get('If-None-Match')):
+                return web.Response(status=304, headers={'ETag': entry.etag, **headers})
+            headers['Content-Type'] = entry.headers.get('Content-Type', 'application/octet-stream')
+            return web.FileResponse(entry.path, headers=headers)
+    response = await upstream_wait(open_stream(url, headers=image_request_headers(request.headers),
+                                               family=route.family))
+    cache_writer = None
+    try:
+        if response.status >= 400:
+            return web.json_response({'error': 'Failed to fetch data'}, status=response.status)
+        stream = MeteredStreamResponse(status=response.status, headers=relay_headers(response, IMAGE_RELAY_HEADERS))
+        cache_writer = image_cache_writer(route, url, response)
+        await stream.prepare(request)
+        async for chunk in upstream_chunks(response.content.iter_any()):
+            if cache_writer is not None:
+                cache_writer.write(chunk)
+            await stream.write(chunk)
+        await stream.write_eof()
+        if cache_writer is not None:
+            disk_cache_pool.submit(cache_writer.commit)
+            cache_writer = None
+        return stream
+    finally:
+        if cache_writer is not None:
+            cache_writer.abort()
+        response.release()
+
+async def aiohttp_route(route, request):
+    """Handle a request for ``route``; the aiohttp counterpart of proxy_route."""
+    if request.method == 'OPTIONS':
+        return web.Response()
+    headers = get_xtoken_header(request)
+    if (route.auth or request.method in WRITE_METHODS) and not headers:
+        return web.json_response({'error': 'x-token header required'}, status=401)
+    fan_out = route.paginated and fanout_requested(request.query)
+    url = route.url(request.match_info, request.query, paging=not fan_out)
+    accept_encoding = request.headers.get('Accept-Encoding', 'identity')
+
+    if route.kind == 'image':
+        return await aiohttp_image(request, route, url)
+    if route.kind == 'session':
+        header = {
+            'x-requested-with': 'XMLHttpRequest',
+            'Accept-Encoding': accept_encoding,
+        }
+        return _aiohttp_response(await upstream_wait(fetch_raw(url, headers=header, cookies=request.cookies,
+                                                               family=route.family)))
+    if request.method in WRITE_METHODS:
+        body = request.content if request.body_exists else None
+        response, replayed = await upstream_wait(send_write(url, request.method,
+                                                            write_headers(request.headers, headers), body,
+                                                            route.family, request.headers.get('Idempotency-Key')))
+        if 200 <= response.status < 300 and route.cache:
+            await asyncio.get_running_loop().run_in_executor(disk_cache_pool, invalidate_cached, route, url)
+        return web.Response(body=response.body, status=response.status,
+                            headers=write_response_headers(response, replayed))
+    try:
+        projection = fields_option(request.query)
+    except ValueError as exc:
+        return web.json_response({'error': str(exc)}, status=400)
+    if fan_out:
+        return await aiohttp_all_pages(request, url, headers, route.family, projection)
+
+    key, response, stale = await cache_lookup_async(route, url, headers, accept_encoding)
+    if response is None:
+        response = await upstream_wait(fetch_json(url, headers=headers, accept_encoding=accept_encoding,
+                                                  stale=stale, family=route.family))
+        cache_store(route, key, response)
+    response = await negotiate_async(await project_async(response, projection), accept_encoding)
+    if response.status == 200 and etag_matches(response.etag, request.headers.get('If-None-Match')):
+        return web.Response(status=304, headers=not_modified_headers(response))
+    return _aiohttp_response(response)
+
+def aiohttp_view(route):
+    """Build the aiohttp handler for a route from the table."""
+    async def handler(request):
+        return await aiohttp_route(route, request)
+    return handler
+
+async def aiohttp_all_pages(request, url, headers, family, projection=None):
+    """Stream every page of a paginated list for an ?all=1 request."""
+    try:
+        max_items, fmt = fanout_options(request.query)
+    except ValueError as exc:
+        return web.json_response({'error': str(exc)}, status=400)
+    pages = iter_all_pages(url, headers, max_items, family)
+    try:
+        first_page = await upstream_wait(pages.__anext__())
+    except PageFetchError as exc:
+        await pages.aclose()
+        return _aiohttp_response(exc.response)
+    except BaseException:
+        await pages.aclose()  # stop the prefetches of later pages
+        raise
+    stream = MeteredStreamResponse(headers={'Content-Type': FANOUT_CONTENT_TYPES[fmt]})
+    await stream.prepare(request)
+    # Only waiting for pages is upstream time; encoding them is the trampoline's.
+    async for chunk in encode_pages(first_page, upstream_chunks(pages), fmt, projection):
+        await stream.write(chunk)
+    await stream.write_eof()
+    return stream
+
+async def aiohttp_cache_stats(request):
+    return web.json_response(cache_stats_report())
+
+async def aiohttp_metrics(request):
+    return web.Response(text=render_metrics(), headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+async def aiohttp_batch(request):
+    if request.method == 'OPTIONS':
+        return web.Response()
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    try:
+        paths, concurrency, timeout, stream = parse_batch(payload)
+    except (TypeError, ValueError) as exc:
+        return web.json_response({'error': str(exc)}, status=400)
+    results = iter_batch(paths, get_xtoken_header(request), concurrency, timeout)
+    if not stream:
+        return web.Response(body=await upstream_wait(collect_batch(results)), content_type='application/json')
+    response = MeteredStreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    async for line in encode_batch_lines(upstream_chunks(results)):
+        await response.write(line)
+    await response.write_eof()
+    return response
+
+def aiohttp_watch(kind, arg):
+    """Build the aiohttp handler streaming one kind of watched resource."""
+    async def handler(request):
+        if request.method in ('HEAD', 'OPTIONS'):
+            return web.Response(headers=WATCH_HEADERS if request.method == 'HEAD' else None)
+        target = request.match_info[arg]
+        if not watch_hub.accepting(kind, target):
+            return web.json_response(WATCH_LIMIT_ERROR, status=503)
+        response = MeteredStreamResponse(headers=WATCH_HEADERS)
+        await response.prepare(request)
+        events = watch_events(kind, target)
+        try:
+            async for chunk in events:
+                await response.write(chunk)
+        finally:
+            await events.aclose()
+        return response
+    return handler
+
+# Endpoints answered by the trampoline itself rather than proxied upstream.
+AIOHTTP_LOCAL_HANDLERS = {
+    'cache_stats': aiohttp_cache_stats,
+    'batch': aiohttp_batch,
+    'metrics': aiohttp_metrics,
+    'watch_studio_activity': aiohttp_watch('activity', 'studioid'),
+    'watch_message_count': aiohttp_watch('messages', 'username'),
+}
+
+def create_aiohttp_app():
+    """Build an aiohttp Application serving the same routes as the Flask app."""
+    aio_app = web.Application(middlewares=[aiohttp_record_metrics, aiohttp_upstream_errors])
+    aio_app.on_response_prepare.append(aiohttp_cors_headers)
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == 'static':
+            continue
+        path = _aiohttp_path(rule.rule)
+        if rule.endpoint in ROUTES_BY_NAME:
+            handler = aiohttp_view(ROUTES_BY_NAME[rule.endpoint])
+        else:
+            handler = AIOHTTP_LOCAL_HANDLERS[rule.endpoint]
+        for method in sorted(rule.methods):
+            aio_app.router.add_route(method, path, handler, name=rule.endpoint)
+
+    async def on_startup(aio_app):
+        await upstream.open()
+
+    async def on_cleanup(aio_app):
+        await upstream.close()
+
+    aio_app.on_startup.append(on_startup)
+    aio_app.on_cleanup.append(on_cleanup)
+    return aio_app
+
+
+# --- pre-fork serving ------------------------------------------------------
+
+GRACEFUL_TIMEOUT = 30  # seconds a stopping worker gets to finish its requests
+WORKER_KEEPALIVE_TIMEOUT = 5  # idle keep-alive connections are closed after this
+MIN_WORKER_LIFETIME = 1  # a worker dying sooner than this is restarted after a pause
+RETIRE_MESSAGE_SIZE = 4  # a retiring worker writes its pid to the master in this many bytes
+
+
+def listen_socket(host, port):
+    """A listening socket on host:port with SO_REUSEPORT, so every worker can have its own."""
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(False)
+    return sock
+
+
+class WorkerRequestHandler(WSGIRequestHandler):
+    # Bounds how long an idle keep-alive connection can hold up a draining worker.
+    timeout = WORKER_KEEPALIVE_TIMEOUT
+
+
+def recycle_after(max_requests, retire):
+    """A callable to count requests; it calls ``retire`` once ``max_requests`` have started."""
+    count = itertools.count(1)
+
+    def counted():
+        if next(count) == max_requests:
+            retire()
+    return counted
+
+
+def serve_flask_worker(sock, counted, graceful_timeout):
+    """Serve the Flask app on ``sock`` until SIGTERM, then finish requests in progress."""
+    wsgi_app = app
+    if counted:
+        def recycling_app(environ, start_response):
+            counted()
+            return app(environ, start_response)
+        wsgi_app = recycling_app
+
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, wsgi_app, threaded=True, request_handler=WorkerRequestHandler,
+                         fd=sock.fileno())
+    # The server listens on a duplicate of the descriptor; close the original
+    # so that server_close() really takes this worker out of the SO_REUSEPORT
+    # group before it waits on requests in progress.
+    sock.close()
+    server.daemon_threads = False  # so server_close() waits for requests in progress
+    # Serve one request at a time rather than with serve_forever(), which
+    # stops as soon as it wakes up after shutdown() and so drops the
+    # connection that woke it.
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    server.timeout = 0.5
+    while not stopping.is_set():
+        server.handle_request()
+    # Closing the socket resets connections the kernel has already queued on
+    # it; serve those first.
+    server.timeout = 0
+    while select.select([server.socket], [], [], 0)[0]:
+        server.handle_request()
+    server.server_close()
+
+
+def serve_aiohttp_worker(sock, counted, graceful_timeout):
+    """Serve the aiohttp app on ``sock``; run_app stops gracefully on SIGTERM."""
+    aio_app = create_aiohttp_app()
+    if counted:
+        @web.middleware
+        async def recycle(request, handler):
+            counted()
+            return await handler(request)
+        aio_app.middlewares.append(recycle)
+    web.run_app(aio_app, sock=sock, shutdown_timeout=graceful_timeout, print=None)
+
+
+class PreforkMaster:
+    """Runs the trampoline in pre-forked worker processes on a shared port.
+
+    Each worker binds its own socket with SO_REUSEPORT and the kernel
+    spreads connections between them. The master never serves requests or
+    opens upstream connections, so every worker starts its own pools and
+    threads after the fork. A worker that has taken ``max_requests``
+    writes its pid to the master over a pipe; like SIGHUP does for all of
+    them, the master starts its replacement first and then drains it.
+    Workers that crash are replaced, after a pause if they die young. SIGHUP
+    starts a fresh set of workers and drains the old ones; SIGTERM or SIGINT
+    drains all workers and exits.
+    Workers still running ``graceful_timeout`` seconds after being asked to
+    stop are killed.
+    """
+
+    def __init__(self, server, host, port, workers, max_requests=0, graceful_timeout=GRACEFUL_TIMEOUT):
+        self.serve = serve_aiohttp_worker if server == 'aiohttp' else serve_flask_worker
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.generation = 0
+        self._children = {}  # pid -> (generation, started); None for workers being retired
+        self._stopping = {}  # pid -> when it was asked to stop
+        self._respawns = []  # (when, generation) for replacements of workers that died young
+        self._signals = deque()
+        self._retiring = None  # read end of the pipe retiring workers write their pid to
+        self._retire_fd = None
+
+    def run(self):
+        listen_socket(self.host, self.port).close()  # fail now, not in every worker, if the port is taken
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self._signals.append(signum))
+        print(f'Serving on http://{self.host}:{self.port} with {self.workers} workers (master pid {os.getpid()})',
+              flush=True)
+        self._retiring, self._retire_fd = os.pipe()
+        os.set_blocking(self._retiring, False)
+        for _ in range(self.workers):
+            self._spawn()
+        while True:
+            while self._signals:
+                signum = self._signals.popleft()
+                if signum == signal.SIGHUP:
+                    self._reload()
+                else:
+                    self._stop_all()
+                    return
+            self._reap()
+            self._respawn_due()
+            self._kill_overdue()
+            select.select([self._retiring], [], [], 0.2)
+            self._replace_retiring()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = (self.generation, time.monotonic())
+            return
+        status = 0
+        try:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the master, which stops us
+            os.close(self._retiring)
+            counted = recycle_after(self.max_requests, self._retire) if self.max_requests else None
+            self.serve(listen_socket(self.host, self.port), counted, self.graceful_timeout)
+            upstream.stop()
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            try:
+                if slow_request_log is not None:
+                    slow_request_log.stop()  # os._exit() skips its atexit handler
+            finally:
+                os._exit(status)
+
+    def _retire(self):
+        """In a worker: ask the master to replace us; it sends SIGTERM once the replacement is up."""
+        try:
+            os.write(self._retire_fd, os.getpid().to_bytes(RETIRE_MESSAGE_SIZE, sys.byteorder))
+        except OSError:
+            os.kill(os.getpid(), signal.SIGTERM)  # no master to ask; just drain
+
+    def _replace_retiring(self):
+        try:
+            message = os.read(self._retiring, 64 * RETIRE_MESSAGE_SIZE)
+        except BlockingIOError:
+            return
+        for offset in range(0, len(message), RETIRE_MESSAGE_SIZE):
+            pid = int.from_bytes(message[offset:offset + RETIRE_MESSAGE_SIZE], sys.byteorder)
+            generation, started = self._children.get(pid, (None, None))
+            if generation != self.generation or pid in self._stopping:
+                continue  # already on its way out
+            self._spawn()
+            self._children[pid] = (None, started)
+            self._terminate(pid)
+
+    def _terminate(self, pid):
+        if pid not in self._stopping:
+            self._stopping[pid] = time.monotonic()
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _reload(self):
+        old = list(self._children)
+        self.generation += 1
+        for _ in range(self.workers):
+            self._spawn()
+        for pid in old:
+            self._terminate(pid)
+
+    def _reap(self):
+        """Collect exited workers and replace those of the current generation."""
+        while self._children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                return
+            generation, started = self._children.pop(pid)
+            self._stopping.pop(pid, None)
+            if generation != self.generation:
+                continue
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                # Don't spin if workers die on startup, but keep serving signals meanwhile.
+                self._respawns.append((time.monotonic() + MIN_WORKER_LIFETIME, generation))
+            else:
+                self._spawn()
+
+    def _respawn_due(self):
+        now = time.monotonic()
+        due = [respawn for respawn in self._respawns if respawn[0] <= now]
+        self._respawns = [respawn for respawn in self._respawns if respawn[0] > now]
+        for _, generation in due:
+            if generation == self.generation:  # not if a reload or stop came in meanwhile
+                self._spawn()
+
+    def _kill_overdue(self):
+        for pid, asked in list(self._stopping.items()):
+            if time.monotonic() - asked > self.graceful_timeout:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def _stop_all(self):
+        self.generation += 1  # nothing exiting from now on is replaced
+        for pid in list(self._children):
+            self._terminate(pid)
+        while self._children:
+            self._reap()
+            self._kill_overdue()
+            time.sleep(0.1)
+
+
+def main(argv=None):
+    global disk_cache, slow_request_log, SERVER_TIMING
+    parser = argparse.ArgumentParser(description='Trampoline for the Scratch API.')
+    parser.add_argument('--server', choices=('flask', 'aiohttp'), default='flask',
+                        help='serve with the Flask app (default) or natively on aiohttp')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--upstream', action='append', default=[], metavar='NAME=URL',
+                        help='send requests for an upstream host elsewhere, e.g. api=http://127.0.0.1:8950')
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='NAME=RATE[:BURST]',
+                        help='requests per second allowed to an upstream host, and the burst '
+                             '(default twice the rate), e.g. api=50:100')
+    parser.add_argument('--disk-cache', metavar='DIR',
+                        help='also cache project metadata and images in DIR, shared with other processes')
+    parser.add_argument('--disk-cache-mb', type=int, default=DISK_CACHE_MAX_BYTES // 2**20,
+                        help='disk space the cache may use (default %(default)s)')
+    parser.add_argument('--server-timing', action='store_true',
+                        help='add a Server-Timing header breaking down where each request spent its time')
+    parser.add_argument('--slow-log', metavar='PATH',
+                        help="append a JSON line for each slow request to PATH ('-' for stderr)")
+    parser.add_argument('--slow-request-ms', type=float, default=SLOW_REQUEST_SECONDS * 1000,
+                        help='requests taking longer than this are slow (default %(default)s)')
+    parser.add_argument('--slow-log-sample', type=float, default=SLOW_LOG_SAMPLE_RATE,
+                        help='share of slow requests to log, from 0 to 1 (default %(default)s)')
+    parser.add_argument('--prefork', action='store_true',
+                        help='serve from pre-forked worker processes sharing the port (SO_REUSEPORT)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='worker processes with --prefork (default: CPU count, %(default)s)')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='with --prefork, replace a worker after this many requests (default: never)')
+    parser.add_argument('--graceful-timeout', type=float, default=GRACEFUL_TIMEOUT,
+                        help='seconds a stopping worker may take to finish its requests')
+    args = parser.parse_args(argv)
+    if args.prefork and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--prefork needs SO_REUSEPORT, which this platform lacks')
+    for override in args.upstream:
+        name, sep, base_url = override.partition('=')
+        if not sep or name not in UPSTREAM_HOSTS:
+            parser.error(f'--upstream takes NAME=URL with NAME one of {", ".join(UPSTREAM_HOSTS)}')
+        UPSTREAM_HOSTS[name] = base_url.rstrip('/')
+    for override in args.rate_limit:
+        name, sep, limit = override.partition('=')
+        rate, _, burst = limit.partition(':')
+        try:
+            rate = float(rate)
+            burst = float(burst) if burst else 2 * rate
+        except ValueError:
+            rate = burst = 0
+        if not sep or name not in UPSTREAM_RATE_LIMITS or rate <= 0 or burst < 1:
+            parser.error(f'--rate-limit takes NAME=RATE[:BURST] with NAME one of {", ".join(UPSTREAM_RATE_LIMITS)}, '
+                         'a positive RATE and a BURST of at least 1')
+        UPSTREAM_RATE_LIMITS[name] = {'rate': rate, 'burst': burst}
+    if args.prefork:
+        # Each worker has its own limiters; give each its share so the
+        # server as a whole keeps to the limits.
+        for limits in UPSTREAM_RATE_LIMITS.values():
+            limits['rate'] /= args.workers
+            limits['burst'] = max(1, limits['burst'] / args.workers)
+    if args.disk_cache:
+        disk_cache = DiskCache(args.disk_cache, args.disk_cache_mb * 2**20)
+    SERVER_TIMING = args.server_timing
+    if args.slow_log:
+        slow_request_log = SlowRequestLog(args.slow_log, args.slow_request_ms / 1000, args.slow_log_sample)
+
+    if args.prefork:
+        PreforkMaster(args.server, args.host, args.port, args.workers, args.max_requests,
+                      args.graceful_timeout).run()
+    elif args.server == 'aiohttp':
+        web.run_app(create_aiohttp_app(), host=args.host, port=args.port)
+    else:
+        app.run(host=args.host, port=args.port, debug=False)
 
 
 if __name__ == '__main__':
-    app.run(debug=False)
\ No newline at end of file
+    main()